@@ -0,0 +1,137 @@
+# Libraries
+import os
+import time
+import threading
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable
+
+# App Modules
+from metrics import Histogram, Counter, add_metric, add_collector
+
+# Turn the admission control off (i.e. behind a proxy that already sheds the load)
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', 'true').lower() == 'true'
+# Reads (GET, HEAD) running at the same time in a process, with the writes
+# at most DB_POOL_SIZE + DB_MAX_OVERFLOW so no admitted request waits for a connection
+READ_CONCURRENCY = int(os.environ.get('READ_CONCURRENCY', 6))
+# Writes (POST, PUT, PATCH, DELETE) running at the same time in a process
+WRITE_CONCURRENCY = int(os.environ.get('WRITE_CONCURRENCY', 2))
+# Requests of each kind waiting for a slot, the next ones are rejected at once
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 8))
+# Longest wait (seconds) for a slot before the request is rejected
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 1.0))
+# Seconds sent in the Retry-After header of the rejections
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+
+# Routes never limited: the monitoring must answer while the API is overloaded
+EXEMPT_PATHS = ( '/metrics', )
+
+queue_wait = add_metric(Histogram(
+    'cinema_admission_queue_wait_seconds',
+    'Time spent by the requests waiting for a slot, admitted or not.',
+    [ 'kind', 'outcome' ]
+))
+rejections = add_metric(Counter(
+    'cinema_admission_rejections_total',
+    'Requests rejected with a 503, by kind and reason (queue_full or timeout).',
+    [ 'kind', 'reason' ]
+))
+
+
+'''
+Limiter
+Concurrency budget of one kind of requests (reads or writes) in a process
+    at most concurrency requests run, at most queue_size wait for a slot,
+    and none waits more than timeout seconds
+    acquire() return None when the request is admitted, the reason of the rejection otherwise
+    release() frees the slot of an admitted request
+'''
+class Limiter:
+    def __init__(self, kind, concurrency, queue_size, timeout):
+        self.kind = kind
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+
+    def acquire(self):
+        start = time.perf_counter()
+        with self.condition:
+            if self.active < self.concurrency:
+                self.active += 1
+                return None
+            if self.waiting >= self.queue_size:
+                reason = 'queue_full'
+            else:
+                self.waiting += 1
+                try:
+                    admitted = self.condition.wait_for(
+                        lambda: self.active < self.concurrency, self.timeout
+                    )
+                finally:
+                    self.waiting -= 1
+                if admitted:
+                    self.active += 1
+                reason = None if admitted else 'timeout'
+
+        queue_wait.observe(
+            (self.kind, 'admitted' if reason is None else 'rejected'),
+            time.perf_counter() - start
+        )
+        if reason is not None:
+            rejections.inc((self.kind, reason))
+        return reason
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+limiters = {
+    'read': Limiter('read', READ_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT),
+    'write': Limiter('write', WRITE_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+}
+
+@add_collector
+def admission_metrics():
+    samples = []
+    for kind, limiter in limiters.items():
+        samples.extend([
+            (f'cinema_admission_{kind}_active', 'gauge', f'{kind.capitalize()} requests running.', limiter.active),
+            (f'cinema_admission_{kind}_waiting', 'gauge', f'{kind.capitalize()} requests waiting for a slot.', limiter.waiting)
+        ])
+    return samples
+
+
+'''
+admit() method
+    before_request hook
+    it should take a read or a write slot for the request, waiting in the queue if needed
+    it should let through the preflight requests, the unknown routes and EXEMPT_PATHS
+    it should raise a 503 with a Retry-After header when the queue is full or the wait too long
+'''
+def admit():
+    if (not ADMISSION_CONTROL or request.method == 'OPTIONS'
+            or request.url_rule is None or request.path in EXEMPT_PATHS):
+        return
+    limiter = limiters['read' if request.method in ('GET', 'HEAD') else 'write']
+
+    reason = limiter.acquire()
+    if reason is not None:
+        description = (
+            f'Too many {limiter.kind} requests ({"no room in the queue" if reason == "queue_full" else "waited too long"}), '
+            f'retry in {ADMISSION_RETRY_AFTER} s.'
+        )
+        raise ServiceUnavailable(description, retry_after=ADMISSION_RETRY_AFTER)
+    g.admission = limiter
+
+'''
+release(error) method
+    teardown_request hook: it runs after a streamed response is sent too,
+    so a stream keeps its slot until its last row
+'''
+def release(error=None):
+    limiter = g.pop('admission', None)
+    if limiter is not None:
+        limiter.release()
@@ -1,47 +1,371 @@
 # Libraries
 import os
-import json
-from flask import Flask, request, jsonify, abort
+import datetime
+import threading
+from flask import Flask, Response, request, abort, stream_with_context
 from flask_cors import CORS
 
 # App Modules
-from models import setup_db, Actor, Movie
+from models import setup_db, Actor, Movie, get_links, add_links, replace_links, remove_links
 from auth import requires_auth
+from json_provider import jsonify, dumps
+from compression import compress_response
+from metrics import start_request, finish_request, check_metrics_token, render_metrics
+import sql_monitor
+import admission
+import replicas
+from http_cache import conditional
+from read_model import read_model
+import stats
+from queries import QueryError, STREAM_BATCH_SIZE, is_plain_list, paginate, stream_query
+from queries import get_fields, load_fields, get_ids, get_many, MAX_ID
 
+# Max number of items accepted by the bulk endpoints
+MAX_BULK_SIZE = int(os.environ.get('MAX_BULK_SIZE', 1000))
+
+# Check for mandatory parameters
+def get_missing_params(body, params):
+    return [ param for param in params if param not in body ]
+
+# Parse a birthdate (YYYY-MM-DD), not every database accepts a string
+def parse_birthdate(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError('birthdate must be a date (YYYY-MM-DD).')
+
+# Validate one actor of a bulk request and return its column values
+def get_actor_row(item):
+    if not isinstance(item, dict):
+        raise ValueError('The item must be an object.')
+
+    missing_params = get_missing_params(item, [
+        'firstname', 'lastname', 'birthdate'
+    ])
+    if missing_params:
+        raise ValueError(f'Missing required parameters: {", ".join(missing_params)}')
+
+    return {
+        'firstname': item['firstname'],
+        'lastname': item['lastname'],
+        'stagename': item.get('stagename', None),
+        'gender': item.get('gender', None),
+        'birthdate': parse_birthdate(item['birthdate'])
+    }
+
+# Validate one movie of a bulk request and return its column values
+def get_movie_row(item):
+    if not isinstance(item, dict):
+        raise ValueError('The item must be an object.')
+
+    missing_params = get_missing_params(item, [
+        'title', 'year', 'duration'
+    ])
+    if missing_params:
+        raise ValueError(f'Missing required parameters: {", ".join(missing_params)}')
+
+    for param in [ 'year', 'duration' ]:
+        value = item[param]
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+            raise ValueError(f'{param} must be an integer.')
+
+    return {
+        'title': item['title'],
+        'genre': item.get('genre', None),
+        'year': item['year'],
+        'duration': item['duration']
+    }
+
+# Columns of the bulk PATCH endpoints, the same ones the single row PATCH routes change
+ACTOR_CHANGES = ( 'stagename', 'gender' )
+MOVIE_CHANGES = ( 'title', 'genre' )
+
+# Validate one {"id": 1, "changes": {...}} item of a bulk PATCH request, return the id and the changes
+def get_item_changes(item, fields):
+    if not isinstance(item, dict):
+        raise ValueError('The item must be an object.')
+
+    row_id = item.get('id')
+    if not isinstance(row_id, int) or isinstance(row_id, bool):
+        raise ValueError('id must be an integer.')
+    if row_id < 1 or row_id > MAX_ID:
+        raise ValueError(f'id must be between 1 and {MAX_ID}.')
+
+    changes = item.get('changes')
+    if not isinstance(changes, dict) or not changes:
+        raise ValueError('changes must be a non empty object.')
+    unknown = [ field for field in changes if field not in fields ]
+    if unknown:
+        raise ValueError(f'Only {", ".join(fields)} can be changed, not: {", ".join(unknown)}')
+    for field, value in changes.items():
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f'{field} must be a string.')
+
+    return row_id, changes
+
+# Update the valid items of a bulk PATCH request at once, report the invalid and missing ones
+def bulk_patch(model, body, fields):
+    changes = {}
+    errors = []
+    for index, item in enumerate(body):
+        try:
+            row_id, values = get_item_changes(item, fields)
+            if row_id in changes:
+                raise ValueError(f'id {row_id} is repeated.')
+            changes[row_id] = values
+        except ValueError as error:
+            errors.append({
+                'index': index,
+                'message': str(error)
+            })
+
+    not_found = model.update_many(changes)
+    missing = set(not_found)
+
+    return jsonify({
+        'success': not errors and not not_found,
+        'updated': [ row_id for row_id in changes if row_id not in missing ],
+        'not_found': not_found,
+        'errors': errors
+    }), 200 if changes else 400
+
+# Check if the client prefers NDJSON over JSON
+def accepts_ndjson():
+    return request.accept_mimetypes.best_match([
+        'application/json', 'application/x-ndjson'
+    ]) == 'application/x-ndjson'
+
+# Check if the client asked for a streamed list (NDJSON or ?stream=true)
+def is_stream_request():
+    return accepts_ndjson() or request.args.get('stream', 'false').lower() == 'true'
+
+# Stream the rows as NDJSON or as a chunked JSON object, a batch of rows per chunk
+def stream_list(key, rows, serialize):
+    ndjson = accepts_ndjson()
+    path = request.path
+
+    def generate():
+        total = 0
+        chunk = [] if ndjson else [ f'{{"success":true,"{key}":[' ]
+        try:
+            for row in rows:
+                item = dumps(serialize(row))
+                if ndjson:
+                    chunk.append(item + '\n')
+                else:
+                    chunk.append(item if total == 0 else ',' + item)
+                total += 1
+                if total % STREAM_BATCH_SIZE == 0:
+                    yield ''.join(chunk)
+                    chunk = []
+        except Exception as error:
+            # the status is already sent: stop here, the body is left incomplete
+            print(f'GET {path} stream error: {error}')
+            return
+
+        if not ndjson:
+            chunk.append(f'],"total":{total}}}')
+        yield ''.join(chunk)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson' if ndjson else 'application/json'
+    )
+
+# Statistics of the catalogue, with the time they were computed (UTC) and whether a table changed since
+def stats_response(row, stale):
+    return jsonify({
+        'success': True,
+        'stats': row.get_data(),
+        'refreshed_at': row.refreshed_at.replace(tzinfo=datetime.timezone.utc).isoformat(),
+        'stale': stale
+    }), 200
+
+# Get the ids of a casting request body, i.e. {"actors": [1, 2]}, without duplicates
+def get_link_ids(body, key, allow_empty=False):
+    if body is None:
+        abort(422)
+
+    ids = body.get(key) if isinstance(body, dict) else None
+    if not isinstance(ids, list) or any(
+            not isinstance(item, int) or isinstance(item, bool) or not 1 <= item <= MAX_ID
+            for item in ids):
+        abort(400, f'Bad Request - {key} must be an array of ids.')
+    if not ids and not allow_empty:
+        abort(400, f'Bad Request - {key} must not be empty.')
+    if len(ids) > MAX_BULK_SIZE:
+        abort(400, f'Bad Request - At most {MAX_BULK_SIZE} ids are allowed.')
+
+    return list(dict.fromkeys(ids))
+
+# Check the body of a bulk request is a list of acceptable size
+def check_bulk_body(body):
+    if body is None:
+        abort(422)
+    if not isinstance(body, list) or not body:
+        abort(400, 'Bad Request - The body must be a non empty array.')
+    if len(body) > MAX_BULK_SIZE:
+        abort(400, f'Bad Request - At most {MAX_BULK_SIZE} items are allowed.')
+
+# Insert the valid items of a bulk request, report the invalid ones
+def bulk_create(model, body, get_row):
+    rows = []
+    indexes = []
+    errors = []
+    for index, item in enumerate(body):
+        try:
+            rows.append(get_row(item))
+            indexes.append(index)
+        except ValueError as error:
+            errors.append({
+                'index': index,
+                'message': str(error)
+            })
+
+    # ids of the created rows in input order, None for the invalid items
+    created = [ None ] * len(body)
+    for index, row_id in zip(indexes, model.insert_many(rows)):
+        created[index] = row_id
+
+    return jsonify({
+        'success': not errors,
+        'created': created,
+        'errors': errors
+    }), 201 if rows else 400
+
+'''
+create_app(test_config) method
+    @INPUTS
+        test_config: optional dict of Flask settings, i.e. the SQLALCHEMY_DATABASE_URI
+            of a test database (DATABASE_URL otherwise)
+
+    it should only build the app: no connection is opened and no table is created
+        until the first request (see manage.py create_schema and the migrations)
+    return the Flask app
+'''
 def create_app(test_config=None):
 
     app = Flask(__name__)
-    setup_db(app)
+    database_path = None
+    replica_paths = None
+    if isinstance(test_config, dict):
+        app.config.update(test_config)
+        database_path = test_config.get('SQLALCHEMY_DATABASE_URI')
+        replica_paths = test_config.get('DATABASE_REPLICA_URLS')
+    setup_db(app, database_path, replica_paths)
+    replicas.init_app(app)
     CORS(app)
 
+    # per-request phase timers, the after_request hook is registered first to run last
+    @app.before_request
+    def before_request():
+        start_request()
+        sql_monitor.start_request()
+        # read / write concurrency budgets, a 503 when the process is overloaded
+        admission.admit()
+        # GET requests read a replica, when there is a healthy one
+        replicas.route_request()
+
+    @app.teardown_request
+    def release_slot(error):
+        admission.release(error)
+
+    @app.after_request
+    def record_timing(response):
+        return finish_request(response)
+
     # CORS configuration using after_request
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Origin', '*')
         response.headers.add(
             'Access-Control-Allow-Headers',
-            'Content-Type,Authorization'
+            'Content-Type,Authorization,X-Read-Your-Writes'
         )
         response.headers.add(
             'Access-Control-Allow-Methods',
-            'GET,POST,PATCH,DELETE'
+            'GET,POST,PUT,PATCH,DELETE'
+        )
+        response.headers.add(
+            'Access-Control-Expose-Headers',
+            'ETag,Last-Modified,Server-Timing,Retry-After'
         )
+        # let the browsers show the Server-Timing of cross origin requests
+        response.headers.add('Timing-Allow-Origin', '*')
         return response
 
+    # read-your-writes cookie of the clients that wrote
+    @app.after_request
+    def remember_write(response):
+        return replicas.remember_write(response)
+
+    # gzip / brotli compression of the large and the streamed responses
+    @app.after_request
+    def compress(response):
+        return compress_response(response)
+
+    # SQL statements count and N+1 detection, registered last to run first:
+    # the 500 of SQL_STRICT still gets the CORS headers and the compression
+    @app.after_request
+    def check_sql(response):
+        return sql_monitor.finish_request(response)
+
     # GET /actors
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @conditional('actors')
     def get_actors():
         try:
-            # get results from db
-            actors = Actor.query.order_by(Actor.id).all()
+            # load and return only the requested fields, if any
+            fields = get_fields(Actor, request.args)
+            query = load_fields(Actor.query, Actor, fields, request.args)
+
+            # get only the requested ids, in the order of the request
+            ids = get_ids(request.args)
+            if ids is not None:
+                if read_model.enabled:
+                    actors, missing = read_model.get().get_many('actors', ids, fields)
+                else:
+                    rows, missing = get_many(query, Actor, ids)
+                    actors = [
+                        actor.partial(fields) if fields else actor.long()
+                        for actor in rows
+                    ]
+                return jsonify({
+                    'success': True,
+                    'total': len(actors),
+                    'actors': actors,
+                    'missing': missing
+                })
+
+            if is_stream_request():
+                # stream all the results from db
+                rows = stream_query(query, Actor, request.args)
+                if fields:
+                    return stream_list('actors', rows, lambda actor: actor.partial(fields))
+                return stream_list('actors', rows, Actor.short)
+
+            if read_model.enabled and is_plain_list(Actor, request.args):
+                # get one page of results from the in-memory snapshot
+                actors, next_cursor = read_model.paginate('actors', request.args, fields)
+            else:
+                # get one page of filtered and sorted results from db
+                rows, next_cursor = paginate(query, Actor, request.args)
+                actors = [
+                    actor.partial(fields) if fields else actor.short()
+                    for actor in rows
+                ]
 
             # return results as json
             return jsonify({
                 'success': True,
                 'total': len(actors),
-                'actors': [ actor.short() for actor in actors ]
+                'actors': actors,
+                'next_cursor': next_cursor
             })
+        except QueryError as error:
+            # bad request
+            abort(400, str(error))
         except Exception as error:
             # internal server error
             print(f'GET /actors error: {error}')
@@ -50,9 +374,21 @@ def create_app(test_config=None):
     # GET /actors/<actor_id>
     @app.route('/actors/<int:actor_id>', methods=['GET'])
     @requires_auth('get:actors')
+    @conditional('actors')
     def get_actor_detail(actor_id):
+        # get the requested fields, if any
+        try:
+            fields = get_fields(Actor, request.args)
+        except QueryError as error:
+            abort(400, str(error))
+
         # check if the actor with the given ID exists
-        actor = Actor.query.get(actor_id)
+        if read_model.enabled:
+            actor = read_model.get().get('actors', actor_id, fields)
+        else:
+            actor = load_fields(Actor.query, Actor, fields).get(actor_id)
+            if actor is not None:
+                actor = actor.partial(fields) if fields else actor.long()
 
         if actor is None:
             # not found
@@ -61,7 +397,7 @@ def create_app(test_config=None):
         try:
             return jsonify({
                 'success': True,
-                'actor': actor.long()
+                'actor': actor
             })
         except Exception as error:
             # internal server error
@@ -78,21 +414,24 @@ def create_app(test_config=None):
             abort(422)
         
         # check for mandatory parameters
-        missing_params = [
-            param for param in [
-                'firstname', 'lastname', 'birthdate'
-            ] if param not in body
-        ]
+        missing_params = get_missing_params(body, [
+            'firstname', 'lastname', 'birthdate'
+        ])
         if missing_params:
             abort(400, f'Bad Request - Missing required parameters: {", ".join(missing_params)}')
 
+        # same validation as the items of POST /actors/bulk
+        try:
+            birthdate = parse_birthdate(body['birthdate'])
+        except ValueError as error:
+            abort(400, f'Bad Request - {error}')
+
         try:
             # get body parameters
             firstname = body.get('firstname', None)
             lastname = body.get('lastname', None)
             stagename = body.get('stagename', None)
             gender = body.get('gender', None)
-            birthdate = body.get('birthdate', None)
 
             # add actor
             actor = Actor(
@@ -113,6 +452,36 @@ def create_app(test_config=None):
             print(f'POST /actors error: {error}')
             abort(500)
     
+    # POST /actors/bulk
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def post_actors_bulk():
+        # get body
+        body = request.get_json()
+        check_bulk_body(body)
+
+        try:
+            return bulk_create(Actor, body, get_actor_row)
+        except Exception as error:
+            # internal server error
+            print(f'POST /actors/bulk error: {error}')
+            abort(500)
+
+    # PATCH /actors/bulk
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    def patch_actors_bulk():
+        # get body
+        body = request.get_json()
+        check_bulk_body(body)
+
+        try:
+            return bulk_patch(Actor, body, ACTOR_CHANGES)
+        except Exception as error:
+            # internal server error
+            print(f'PATCH /actors/bulk error: {error}')
+            abort(500)
+
     # PATCH /actors/<actor_id>
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
@@ -176,20 +545,134 @@ def create_app(test_config=None):
             # internal server error
             abort(500)
     
+    # GET /actors/<actor_id>/movies
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @requires_auth('get:actors')
+    @conditional('actors', 'recitations')
+    def get_actor_movies(actor_id):
+        # check if the actor with the given ID exists
+        if read_model.enabled:
+            snapshot = read_model.get()
+            actor = snapshot.get('actors', actor_id)
+        else:
+            actor = Actor.query.get(actor_id)
+
+        if actor is None:
+            # not found
+            abort(404, 'Actor not found')
+
+        try:
+            if read_model.enabled:
+                movie_ids = list(snapshot.actor_movies.get(actor_id, ()))
+            else:
+                movie_ids = get_links('actor_id', actor_id)
+
+            return jsonify({
+                'success': True,
+                'actor': actor_id,
+                'movies': movie_ids
+            })
+        except Exception as error:
+            # internal server error
+            print(f'GET /actors/{actor_id}/movies error: {error}')
+            abort(500)
+
+    # POST, PUT, DELETE /actors/<actor_id>/movies
+    @app.route('/actors/<int:actor_id>/movies', methods=['POST', 'PUT', 'DELETE'])
+    @requires_auth('patch:actors')
+    def cast_actor(actor_id):
+        # check if the actor with the given ID exists
+        actor = Actor.query.get(actor_id)
+
+        if actor is None:
+            # not found
+            abort(404, 'Actor not found')
+
+        # get the movies ids, PUT with an empty array removes all of them
+        movie_ids = get_link_ids(
+            request.get_json(),
+            'movies',
+            allow_empty=request.method == 'PUT'
+        )
+
+        try:
+            not_found = []
+            if request.method == 'POST':
+                not_found = add_links('actor_id', actor_id, movie_ids)
+            elif request.method == 'PUT':
+                not_found = replace_links('actor_id', actor_id, movie_ids)
+            else:
+                remove_links('actor_id', actor_id, movie_ids)
+
+            # ok
+            return jsonify({
+                'success': True,
+                'actor': actor_id,
+                'movies': get_links('actor_id', actor_id),
+                'not_found': not_found
+            }), 200
+        except Exception as error:
+            print(f'{request.method} /actors/{actor_id}/movies - error: {error}')
+
+            # internal server error
+            abort(500)
+    
     # GET /movies
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @conditional('movies')
     def get_movies():
         try:
-            # get results from db
-            movies = Movie.query.order_by(Movie.id).all()
+            # load and return only the requested fields, if any
+            fields = get_fields(Movie, request.args)
+            query = load_fields(Movie.query, Movie, fields, request.args)
+
+            # get only the requested ids, in the order of the request
+            ids = get_ids(request.args)
+            if ids is not None:
+                if read_model.enabled:
+                    movies, missing = read_model.get().get_many('movies', ids, fields)
+                else:
+                    rows, missing = get_many(query, Movie, ids)
+                    movies = [
+                        movie.partial(fields) if fields else movie.long()
+                        for movie in rows
+                    ]
+                return jsonify({
+                    'success': True,
+                    'total': len(movies),
+                    'movies': movies,
+                    'missing': missing
+                })
+
+            if is_stream_request():
+                # stream all the results from db
+                rows = stream_query(query, Movie, request.args)
+                if fields:
+                    return stream_list('movies', rows, lambda movie: movie.partial(fields))
+                return stream_list('movies', rows, Movie.short)
+
+            if read_model.enabled and is_plain_list(Movie, request.args):
+                # get one page of results from the in-memory snapshot
+                movies, next_cursor = read_model.paginate('movies', request.args, fields)
+            else:
+                # get one page of filtered and sorted results from db
+                rows, next_cursor = paginate(query, Movie, request.args)
+                movies = [
+                    movie.partial(fields) if fields else movie.short()
+                    for movie in rows
+                ]
 
             # return results as json
             return jsonify({
                 'success': True,
                 'total': len(movies),
-                'movies': [ movie.short() for movie in movies ]
+                'movies': movies,
+                'next_cursor': next_cursor
             })
+        except QueryError as error:
+            # bad request
+            abort(400, str(error))
         except Exception as error:
             # internal server error
             print(f'GET /movies error: {error}')
@@ -198,9 +681,21 @@ def create_app(test_config=None):
     # GET /movies/<movie_id>
     @app.route('/movies/<int:movie_id>', methods=['GET'])
     @requires_auth('get:movies')
+    @conditional('movies')
     def get_movie_detail(movie_id):
+        # get the requested fields, if any
+        try:
+            fields = get_fields(Movie, request.args)
+        except QueryError as error:
+            abort(400, str(error))
+
         # check if the movie with the given ID exists
-        movie = Movie.query.get(movie_id)
+        if read_model.enabled:
+            movie = read_model.get().get('movies', movie_id, fields)
+        else:
+            movie = load_fields(Movie.query, Movie, fields).get(movie_id)
+            if movie is not None:
+                movie = movie.partial(fields) if fields else movie.long()
 
         if movie is None:
             # not found
@@ -209,7 +704,7 @@ def create_app(test_config=None):
         try:
             return jsonify({
                 'success': True,
-                'movie': movie.long()
+                'movie': movie
             })
         except Exception as error:
             # internal server error
@@ -226,11 +721,9 @@ def create_app(test_config=None):
             abort(422)
         
         # check for mandatory parameters
-        missing_params = [
-            param for param in [
-                'title', 'year', 'duration'
-            ] if param not in body
-        ]
+        missing_params = get_missing_params(body, [
+            'title', 'year', 'duration'
+        ])
         if missing_params:
             abort(400, f'Bad Request - Missing required parameters: {", ".join(missing_params)}')
 
@@ -259,6 +752,36 @@ def create_app(test_config=None):
             print(f'POST /movies error: {error}')
             abort(500)
     
+    # POST /movies/bulk
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def post_movies_bulk():
+        # get body
+        body = request.get_json()
+        check_bulk_body(body)
+
+        try:
+            return bulk_create(Movie, body, get_movie_row)
+        except Exception as error:
+            # internal server error
+            print(f'POST /movies/bulk error: {error}')
+            abort(500)
+
+    # PATCH /movies/bulk
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    def patch_movies_bulk():
+        # get body
+        body = request.get_json()
+        check_bulk_body(body)
+
+        try:
+            return bulk_patch(Movie, body, MOVIE_CHANGES)
+        except Exception as error:
+            # internal server error
+            print(f'PATCH /movies/bulk error: {error}')
+            abort(500)
+
     # PATCH /movies/<movie_id>
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
@@ -322,6 +845,101 @@ def create_app(test_config=None):
             # internal server error
             abort(500)
     
+    # GET /movies/<movie_id>/actors
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @requires_auth('get:movies')
+    @conditional('movies', 'recitations')
+    def get_movie_actors(movie_id):
+        # check if the movie with the given ID exists
+        if read_model.enabled:
+            snapshot = read_model.get()
+            movie = snapshot.get('movies', movie_id)
+        else:
+            movie = Movie.query.get(movie_id)
+
+        if movie is None:
+            # not found
+            abort(404, 'Movie not found')
+
+        try:
+            if read_model.enabled:
+                actor_ids = list(snapshot.movie_actors.get(movie_id, ()))
+            else:
+                actor_ids = get_links('movie_id', movie_id)
+
+            return jsonify({
+                'success': True,
+                'movie': movie_id,
+                'actors': actor_ids
+            })
+        except Exception as error:
+            # internal server error
+            print(f'GET /movies/{movie_id}/actors error: {error}')
+            abort(500)
+
+    # POST, PUT, DELETE /movies/<movie_id>/actors
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST', 'PUT', 'DELETE'])
+    @requires_auth('patch:movies')
+    def cast_movie(movie_id):
+        # check if the movie with the given ID exists
+        movie = Movie.query.get(movie_id)
+
+        if movie is None:
+            # not found
+            abort(404, 'Movie not found')
+
+        # get the actors ids, PUT with an empty array removes all of them
+        actor_ids = get_link_ids(
+            request.get_json(),
+            'actors',
+            allow_empty=request.method == 'PUT'
+        )
+
+        try:
+            not_found = []
+            if request.method == 'POST':
+                not_found = add_links('movie_id', movie_id, actor_ids)
+            elif request.method == 'PUT':
+                not_found = replace_links('movie_id', movie_id, actor_ids)
+            else:
+                remove_links('movie_id', movie_id, actor_ids)
+
+            # ok
+            return jsonify({
+                'success': True,
+                'movie': movie_id,
+                'actors': get_links('movie_id', movie_id),
+                'not_found': not_found
+            }), 200
+        except Exception as error:
+            print(f'{request.method} /movies/{movie_id}/actors - error: {error}')
+
+            # internal server error
+            abort(500)
+    
+    # GET /stats
+    @app.route('/stats', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_stats():
+        try:
+            row, stale = stats.get_stats()
+            return stats_response(row, stale)
+        except Exception as error:
+            # internal server error
+            print(f'GET /stats error: {error}')
+            abort(500)
+
+    # POST /stats/refresh
+    @app.route('/stats/refresh', methods=['POST'])
+    @requires_auth('patch:movies')
+    def refresh_stats():
+        try:
+            return stats_response(stats.refresh_stats(), False)
+        except Exception as error:
+            # internal server error
+            print(f'POST /stats/refresh error: {error}')
+            abort(500)
+
     # GET /
     @app.route('/')
     def get_greeting():
@@ -331,6 +949,12 @@ def create_app(test_config=None):
             greeting = greeting + '!!!!! You are doing great in this Udacity project.'
         return greeting
 
+    # GET /metrics
+    @app.route('/metrics')
+    def get_metrics():
+        check_metrics_token()
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
     # GET /coolkids
     @app.route('/coolkids')
     def be_cool():
@@ -339,13 +963,22 @@ def create_app(test_config=None):
 
     # Error Handlers
 
+    # 400 Error Handler
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+            'success': False,
+            'error': 400,
+            'message': error.description
+        }), 400
+
     # 401 Error Handler
     @app.errorhandler(401)
     def unauthorized(error):
         return jsonify({
             'success': False,
             'error': 401,
-            'message': json.dumps(error)
+            'message': error.description
         }), 401
     
     # 403 Error Handler
@@ -354,7 +987,7 @@ def create_app(test_config=None):
         return jsonify({
             'success': False,
             'error': 403,
-            'message': json.dumps(error)
+            'message': error.description
         }), 403
 
     # 404 Error Handler
@@ -386,6 +1019,19 @@ def create_app(test_config=None):
             'message': 'unprocessable'
         }), 422
 
+    # 503 Error Handler, the client should retry after error.retry_after seconds
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            'success': False,
+            'error': 503,
+            'message': error.description
+        })
+        response.status_code = 503
+        if error.retry_after is not None:
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
     # 500 Error Handler
     @app.errorhandler(500)
     def internal_server_error(error):
@@ -397,7 +1043,20 @@ def create_app(test_config=None):
 
     return app
 
-app = create_app()
+# App served by gunicorn (app:app) and manage.py, created on first access
+_app = None
+_app_lock = threading.Lock()
+
+def __getattr__(name):
+    global _app
+
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    with _app_lock:
+        if _app is None:
+            _app = create_app()
+    return _app
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
@@ -1,18 +1,43 @@
 # Libraries
 import os
+import re
 import json
-from flask import request, jsonify
+import math
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request
 from functools import wraps
+from werkzeug.exceptions import ServiceUnavailable
+import ssl
+import http.client
 import jwt
-from urllib.request import urlopen
+from urllib.parse import urlsplit
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 import base64
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
+# App Modules
+from json_provider import jsonify
+from metrics import record_phase, add_collector
+
 ALGORITHMS = ['RS256']
-API_AUDIENCE = os.environ['API_AUDIENCE']
+# Overrides of the AUTH0_DOMAIN and API_AUDIENCE variables, read on first use otherwise
+AUTH0_DOMAIN = None
+API_AUDIENCE = None
+
+# JWKS cache settings (seconds)
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 10))
+JWKS_RETRY_INTERVAL = int(os.environ.get('JWKS_RETRY_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 2))
+# Override of the JWKS endpoint (i.e. a local stub), defaults to the Auth0 tenant one
+JWKS_URL = os.environ.get('JWKS_URL')
+
+# Max number of verified tokens kept in memory (0 disables the cache)
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
 
 
 ## AuthError Exception
@@ -25,6 +50,17 @@ class AuthError(Exception):
         self.error = error
         self.status_code = status_code
 
+'''
+JWKSUnavailableError Exception
+The last JWKS fetch failed with no keys to fall back to, the next one is
+not due before JWKS_RETRY_INTERVAL seconds
+    retry_after: seconds left until the next fetch (at least 1)
+'''
+class JWKSUnavailableError(Exception):
+    def __init__(self, cache):
+        super().__init__(f'JWKS fetch failed: {cache["error"]}')
+        self.retry_after = max(1, math.ceil(cache['expires_at'] - time.monotonic()))
+
 ## Auth Header
 '''
 get_token_auth_header() method
@@ -62,24 +98,28 @@ def get_token_auth_header():
     return parts[1]
 
 '''
-check_permissions(permission, payload) method
+check_permissions(permission, payload, permissions) method
     @INPUTS
         permission: string permission (i.e. 'post:drink')
         payload: decoded jwt payload
+        permissions: optional precomputed set of the payload permissions
 
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
     it should raise an AuthError if the requested permission string is not in the payload permissions array
     return true otherwise
 '''
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, permissions=None):
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    if permissions is None:
+        permissions = frozenset(payload['permissions'])
+
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -94,8 +134,8 @@ def base64url_to_int(value):
     decoded_bytes = base64.urlsafe_b64decode(padded_value.encode('utf-8'))
     return int.from_bytes(decoded_bytes, 'big')
 
-# Convert the key from JWK to PEM
-def jwk_to_pem(jwk):
+# Build an RSA public key object from a JWK
+def jwk_to_public_key(jwk):
     if jwk['kty'] != 'RSA':
         raise ValueError("Unsupported key type. Only RSA keys are supported.")
 
@@ -104,7 +144,11 @@ def jwk_to_pem(jwk):
         base64url_to_int(jwk['n'])
     )
 
-    public_key = public_numbers.public_key(default_backend())
+    return public_numbers.public_key(default_backend())
+
+# Convert the key from JWK to PEM
+def jwk_to_pem(jwk):
+    public_key = jwk_to_public_key(jwk)
     pem_key = public_key.public_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PublicFormat.SubjectPublicKeyInfo
@@ -112,19 +156,278 @@ def jwk_to_pem(jwk):
 
     return pem_key.decode('utf-8')
 
-# Get public key from Auth0
-def get_public_key(jwks_url, kid):
-    # Fetch JWKS from the well-known JWKS endpoint
-    jwks_response = urlopen(jwks_url)
-    jwks_data = json.loads(jwks_response.read())
+## JWKS Fetcher
+'''
+JWKSFetcher
+Keep-alive HTTP client for the JWKS endpoint
+    it keeps one connection open per process and opens a new one after a fork
+    every connect/read on the socket is bounded by the timeout (seconds)
+    callers must serialize the requests (see refresh_jwks)
+'''
+class JWKSFetcher:
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.connection = None
+        self.origin = None
+        self.pid = None
+        self.requests = 0
+
+    def connect(self, url):
+        parts = urlsplit(url)
+        origin = (parts.scheme, parts.netloc)
+
+        if self.connection is not None and (
+                self.origin != origin or self.pid != os.getpid()):
+            self.close()
+
+        if self.connection is None:
+            if parts.scheme == 'https':
+                self.connection = http.client.HTTPSConnection(
+                    parts.netloc,
+                    timeout=self.timeout,
+                    context=ssl.create_default_context()
+                )
+            else:
+                self.connection = http.client.HTTPConnection(
+                    parts.netloc,
+                    timeout=self.timeout
+                )
+            self.origin = origin
+            self.pid = os.getpid()
+            self.requests = 0
+
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.origin = None
+        self.pid = None
+
+    # GET the url, return the (body, Cache-Control header) tuple
+    def get(self, url):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
 
-    # Find the public key associated with the given 'kid' (Key ID)
+        while True:
+            connection = self.connect(url)
+            reused = self.requests > 0
+            try:
+                connection.request('GET', path, headers={
+                    'Accept': 'application/json'
+                })
+                response = connection.getresponse()
+                body = response.read()
+                self.requests += 1
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                if reused:
+                    # the server dropped the idle keep-alive connection: retry once
+                    continue
+                raise
+            except Exception:
+                self.close()
+                raise
+
+            if response.will_close:
+                self.close()
+
+            if response.status != 200:
+                raise http.client.HTTPException(
+                    f'JWKS endpoint returned HTTP {response.status}'
+                )
+
+            return body, response.getheader('Cache-Control')
+
+_jwks_fetcher = JWKSFetcher(JWKS_FETCH_TIMEOUT)
+
+## JWKS Cache
+'''
+Process-wide JWKS cache
+    url: JWKS endpoint the keys were fetched from
+    keys: public key objects ready for jwt.decode, indexed by 'kid'
+    expires_at: when the key set must be fetched again
+    fetched_at: when the key set was last fetched (or the last fetch failed)
+    error: message of the failed fetch when there were no keys to fall back to,
+        kept until expires_at so the callers back off instead of fetching again
+The dict is never modified: refresh_jwks swaps in a new one, so readers need no lock.
+'''
+_jwks_cache = {
+    'url': None,
+    'keys': {},
+    'expires_at': 0,
+    'fetched_at': 0,
+    'error': None
+}
+_jwks_lock = threading.Lock()
+
+# Get the Auth0 tenant domain
+def get_auth0_domain():
+    return AUTH0_DOMAIN or os.environ['AUTH0_DOMAIN']
+
+# Get the identifier of this API in Auth0 (the 'aud' claim of the tokens)
+def get_api_audience():
+    return API_AUDIENCE or os.environ['API_AUDIENCE']
+
+# Get the url of the JWKS document
+def get_jwks_url():
+    return JWKS_URL or f'https://{get_auth0_domain()}/.well-known/jwks.json'
+
+# Get the max-age (seconds) from a Cache-Control header, if any
+def parse_max_age(cache_control):
+    if not cache_control:
+        return None
+    match = re.search(r'max-age\s*=\s*(\d+)', cache_control)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+# Fetch the JWKS and build the public keys
+def fetch_jwks(jwks_url):
+    body, cache_control = _jwks_fetcher.get(jwks_url)
+    jwks_data = json.loads(body)
+
+    keys = {}
     for key in jwks_data['keys']:
-        if key['kid'].strip() == kid.strip():
-            key_type = key.get('kty')
-            return jwk_to_pem(key)
+        if key.get('kty') != 'RSA' or 'kid' not in key:
+            continue
+        keys[key['kid'].strip()] = jwk_to_public_key(key)
+
+    max_age = parse_max_age(cache_control)
+    ttl = JWKS_CACHE_TTL if max_age is None else max_age
+
+    return keys, ttl
 
-    return None
+'''
+refresh_jwks(jwks_url, seen) method
+    @INPUTS
+        jwks_url: url of the /.well-known/jwks.json document
+        seen: the _jwks_cache dict the caller found stale
+
+    it should run a single fetch per process at a time (single flight):
+        callers waiting on a running fetch reuse its result instead of fetching again
+    it should give up waiting after twice the fetch timeout and keep the cached keys
+    it should keep serving the last known keys when the fetch fails,
+        and try again after JWKS_RETRY_INTERVAL seconds
+    it should raise a JWKSUnavailableError when there are no keys to fall back to, and
+        cache the failure until JWKS_RETRY_INTERVAL seconds: the waiting callers
+        and the next ones get one too without fetching again
+'''
+def refresh_jwks(jwks_url, seen):
+    global _jwks_cache
+
+    if not _jwks_lock.acquire(timeout=JWKS_FETCH_TIMEOUT * 2):
+        print('JWKS fetch still running, serving the cached keys')
+        return
+
+    try:
+        if _jwks_cache is not seen:
+            # another thread refreshed the keys while we were waiting
+            return
+
+        try:
+            keys, ttl = fetch_jwks(jwks_url)
+        except Exception as error:
+            now = time.monotonic()
+            if seen['url'] == jwks_url and seen['keys']:
+                print(f'JWKS fetch error, serving the last known keys: {error}')
+                _jwks_cache = dict(
+                    seen,
+                    expires_at=now + JWKS_RETRY_INTERVAL,
+                    fetched_at=now
+                )
+                return
+            print(f'JWKS fetch error, retrying in {JWKS_RETRY_INTERVAL} s: {error}')
+            _jwks_cache = {
+                'url': jwks_url,
+                'keys': {},
+                'expires_at': now + JWKS_RETRY_INTERVAL,
+                'fetched_at': now,
+                'error': str(error)
+            }
+            raise JWKSUnavailableError(_jwks_cache) from error
+
+        now = time.monotonic()
+        _jwks_cache = {
+            'url': jwks_url,
+            'keys': keys,
+            'expires_at': now + ttl,
+            'fetched_at': now,
+            'error': None
+        }
+    finally:
+        _jwks_lock.release()
+
+# Empty the JWKS cache and close the JWKS connection
+def clear_jwks_cache():
+    global _jwks_cache
+
+    with _jwks_lock:
+        _jwks_cache = {
+            'url': None,
+            'keys': {},
+            'expires_at': 0,
+            'fetched_at': 0,
+            'error': None
+        }
+        _jwks_fetcher.close()
+
+'''
+warm_jwks() method
+    it should fetch the key set once, i.e. in the gunicorn master before the
+        workers are forked, so they share it copy-on-write
+    it should close the JWKS connection, the workers open their own
+    return True if the keys are cached
+'''
+def warm_jwks():
+    try:
+        refresh_jwks(get_jwks_url(), _jwks_cache)
+    except Exception as error:
+        print(f'JWKS warm up error: {error}')
+    finally:
+        with _jwks_lock:
+            _jwks_fetcher.close()
+
+    return bool(_jwks_cache['keys'])
+
+'''
+get_public_key(jwks_url, kid) method
+    @INPUTS
+        jwks_url: url of the /.well-known/jwks.json document
+        kid: key id from the token header
+
+    it should serve the key from the cache while the key set is fresh
+    it should fetch the key set again when it is expired
+    it should fetch the key set once more when the kid is unknown (key rotation),
+        at most once every JWKS_MIN_REFRESH_INTERVAL seconds
+    it should raise a JWKSUnavailableError while a failed fetch is cached
+    return the public key object, or None if the kid is not in the key set
+'''
+def get_public_key(jwks_url, kid):
+    kid = kid.strip()
+
+    cache = _jwks_cache
+    now = time.monotonic()
+    if cache['url'] == jwks_url and now < cache['expires_at']:
+        if cache['error'] is not None:
+            raise JWKSUnavailableError(cache)
+        key = cache['keys'].get(kid)
+        if key is not None or now - cache['fetched_at'] < JWKS_MIN_REFRESH_INTERVAL:
+            return key
+        # unknown kid: the signing keys may have been rotated
+
+    refresh_jwks(jwks_url, cache)
+
+    cache = _jwks_cache
+    if cache['url'] != jwks_url:
+        return None
+    if cache['error'] is not None:
+        # the fetch this caller waited for failed
+        raise JWKSUnavailableError(cache)
+    return cache['keys'].get(kid)
 
 '''
 verify_decode_jwt(token) method
@@ -135,13 +438,12 @@ verify_decode_jwt(token) method
     it should verify the token using Auth0 /.well-known/jwks.json
     it should decode the payload from the token
     it should validate the claims
+    it should let a JWKSUnavailableError through, the token is not known to be invalid
     return the decoded payload
-
-    !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
     # Prepare auth0 url
-    jwks_url = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+    jwks_url = get_jwks_url()
 
     try:
         # Decode the header of the token to get the 'kid' (Key ID)
@@ -157,8 +459,8 @@ def verify_decode_jwt(token):
                 token,
                 public_key,
                 algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer=f'https://{AUTH0_DOMAIN}/'
+                audience=get_api_audience(),
+                issuer=f'https://{get_auth0_domain()}/'
             )
             print("Token verification successful")
             return payload
@@ -169,6 +471,9 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
             }, 401)
 
+    except JWKSUnavailableError:
+        # the token may be valid: the client should retry it, not drop it
+        raise
     except jwt.ExpiredSignatureError as e:
         raise AuthError({
             'code': 'token_expired',
@@ -186,33 +491,140 @@ def verify_decode_jwt(token):
             'description': 'Unable to parse authentication token.'
         }, 401)
 
+## Verified Token Cache
+'''
+Process-wide LRU cache of verified tokens
+    indexed by the sha256 of the token, so raw tokens are not kept in memory
+    each entry holds (payload, permissions set, exp) and is dropped once the token expires
+'''
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+_token_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'miss_seconds': 0.0
+}
+
+# Hash of the token used as cache key
+def token_cache_key(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+# Statistics of the verified token cache
+def token_cache_info():
+    with _token_cache_lock:
+        return {
+            'hits': _token_cache_stats['hits'],
+            'misses': _token_cache_stats['misses'],
+            'miss_seconds': _token_cache_stats['miss_seconds'],
+            'size': len(_token_cache),
+            'maxsize': TOKEN_CACHE_SIZE
+        }
+
+@add_collector
+def token_cache_metrics():
+    info = token_cache_info()
+    return [
+        ('cinema_token_cache_hits_total', 'counter', 'Tokens served from the verified token cache.', info['hits']),
+        ('cinema_token_cache_misses_total', 'counter', 'Tokens verified with the JWKS keys.', info['misses']),
+        ('cinema_token_cache_miss_seconds_total', 'counter', 'Time spent verifying the tokens not in the cache.', info['miss_seconds']),
+        ('cinema_token_cache_size', 'gauge', 'Tokens in the verified token cache.', info['size'])
+    ]
+
+# Empty the verified token cache and reset its statistics
+def clear_token_cache():
+    with _token_cache_lock:
+        _token_cache.clear()
+        _token_cache_stats.update({
+            'hits': 0,
+            'misses': 0,
+            'miss_seconds': 0.0
+        })
+
+'''
+verify_decode_jwt_cached(token) method
+    @INPUTS
+        token: a json web token (string)
+
+    it should return the cached payload while the token is not expired
+    it should use the verify_decode_jwt method on a cache miss
+    it should cache only tokens with an 'exp' claim
+    it should count hits, misses and the seconds spent verifying on misses
+    return a (payload, permissions) tuple, permissions being a frozenset
+'''
+def verify_decode_jwt_cached(token):
+    key = token_cache_key(token)
+
+    with _token_cache_lock:
+        entry = _token_cache.get(key)
+        if entry is not None:
+            payload, permissions, expires_at = entry
+            if time.time() < expires_at:
+                _token_cache.move_to_end(key)
+                _token_cache_stats['hits'] += 1
+                return payload, permissions
+            del _token_cache[key]
+        _token_cache_stats['misses'] += 1
+
+    start = time.perf_counter()
+    try:
+        payload = verify_decode_jwt(token)
+    finally:
+        elapsed = time.perf_counter() - start
+        with _token_cache_lock:
+            _token_cache_stats['miss_seconds'] += elapsed
+
+    permissions = frozenset(payload.get('permissions', ()))
+    expires_at = payload.get('exp')
+
+    if TOKEN_CACHE_SIZE > 0 and isinstance(expires_at, (int, float)):
+        with _token_cache_lock:
+            _token_cache[key] = (payload, permissions, expires_at)
+            _token_cache.move_to_end(key)
+            while len(_token_cache) > TOKEN_CACHE_SIZE:
+                _token_cache.popitem(last=False)
+
+    return payload, permissions
+
 '''
 @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:drink')
 
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
+    it should use the verify_decode_jwt_cached method to decode the jwt
     it should use the check_permissions method validate claims and check the requested permission
+    it should raise a 503 with a Retry-After header while the key set can not be fetched
     return the decorator which passes the decoded payload to the decorated method
 '''
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
+            start = time.perf_counter()
             try:
                 token = get_token_auth_header()
-                payload = verify_decode_jwt(token)
-                check_permissions(permission, payload)
-                #return f(payload, *args, **kwargs)
-                return f(*args, **kwargs)
+                payload, permissions = verify_decode_jwt_cached(token)
+                check_permissions(permission, payload, permissions)
             except AuthError as auth_error:
+                record_phase('auth', time.perf_counter() - start)
                 # Handle AuthError and return the appropriate HTTP response
                 return jsonify({
                     'success': False,
                     'error': auth_error.status_code,
                     'message': auth_error.error,
                 }), auth_error.status_code
+            except JWKSUnavailableError as error:
+                record_phase('auth', time.perf_counter() - start)
+                # the IdP is down and no key is cached: a 503 like the admission control ones
+                print(f'Auth unavailable: {error}')
+                raise ServiceUnavailable(
+                    f'Unable to verify the token now, retry in {error.retry_after} s.',
+                    retry_after=error.retry_after
+                )
+
+            record_phase('auth', time.perf_counter() - start)
+            #return f(payload, *args, **kwargs)
+            return f(*args, **kwargs)
 
         return wrapper
 
@@ -0,0 +1,446 @@
+# Libraries
+import os
+import sys
+import json
+import time
+import datetime
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('EXCITED', 'true')
+
+# App Modules
+from app import create_app
+from models import db, create_schema, recitations, bump_version, Actor, Movie
+from jwks_stub import JWKSStub
+from read_model import read_model
+import auth
+
+'''
+Offline benchmark of the API
+
+It signs the tokens with a local JWKS stub (no Auth0) and runs every route of
+create_app in process, through the Flask test client, against a new SQLite
+database or the --database-url one, at several data sizes:
+
+    python benchmarks/api.py run --sizes 100,1000,10000 --output report.json
+    python benchmarks/api.py compare baseline.json report.json --max-regression 0.2
+
+The JSON report holds, per data size and route, the throughput and the
+p50 / p95 / p99 latencies; compare exits with 1 when a p95 grew too much.
+'''
+
+ISSUER_DOMAIN = 'benchmark.auth0.com'
+AUDIENCE = 'cinema'
+# Links of each movie in the seeded data
+CAST_SIZE = 5
+BULK_SIZE = 100
+IDS_SIZE = 50
+
+
+## Seeding
+def actor_row(i):
+    return {
+        'firstname': f'Firstname {i}',
+        'lastname': f'Lastname {i:06d}',
+        'stagename': f'Stagename {i}',
+        'gender': 'female' if i % 2 else 'male',
+        'birthdate': datetime.date(1950, 1, 1) + datetime.timedelta(days=i % 20000)
+    }
+
+def movie_row(i):
+    return {
+        'title': f'Title {i}',
+        'genre': [ 'Comedy', 'Drama', 'Horror', 'Western' ][i % 4],
+        'year': 1950 + i % 70,
+        'duration': 80 + i % 90
+    }
+
+'''
+seed(app, size) method
+    it should empty the database and insert size actors, size movies and
+        CAST_SIZE actors per movie
+    return the (actor_ids, movie_ids) tuple
+'''
+def seed(app, size):
+    with app.app_context():
+        db.drop_all()
+        create_schema(app)
+        actor_ids = Actor.insert_many([ actor_row(i) for i in range(size) ])
+        movie_ids = Movie.insert_many([ movie_row(i) for i in range(size) ])
+        links = [
+            { 'movie_id': movie_id, 'actor_id': actor_ids[(index + offset) % size] }
+            for index, movie_id in enumerate(movie_ids)
+            for offset in range(min(CAST_SIZE, size))
+        ]
+        if links:
+            db.session.execute(recitations.insert(), links)
+        bump_version('recitations')
+        db.session.commit()
+        db.session.remove()
+    return actor_ids, movie_ids
+
+
+## Route cases
+'''
+Context of the cases of one data size
+    actor_ids / movie_ids: seeded ids
+    pools: ids created before a case that deletes one row per request
+'''
+class Context:
+    def __init__(self, app, actor_ids, movie_ids):
+        self.app = app
+        self.actor_ids = actor_ids
+        self.movie_ids = movie_ids
+        self.pools = {}
+
+    # Seeded id for the request i, spread over the whole table
+    def actor_id(self, i):
+        return self.actor_ids[(i * 7919) % len(self.actor_ids)]
+
+    def movie_id(self, i):
+        return self.movie_ids[(i * 7919) % len(self.movie_ids)]
+
+    # Create count rows to be deleted by a DELETE case
+    def fill_pool(self, model, row, count):
+        with self.app.app_context():
+            self.pools[model.__tablename__] = model.insert_many([ row(i) for i in range(count) ])
+            db.session.remove()
+
+'''
+Case
+One benchmarked request
+    name: label in the report
+    method, rule: the route of create_app it exercises
+    url(context, i): url of the request i
+    body(context, i): json body, if any
+    permission: the only permission of the token
+    prepare(context, count): run before the timed requests, if any
+'''
+class Case:
+    def __init__(self, name, method, rule, url, permission=None, body=None, prepare=None):
+        self.name = name
+        self.method = method
+        self.rule = rule
+        self.url = url
+        self.permission = permission
+        self.body = body
+        self.prepare = prepare
+
+def get_cases():
+    ids = lambda get_id: lambda c, i: ','.join(str(get_id(c, i + n)) for n in range(IDS_SIZE))
+    return [
+        Case('GET /actors', 'GET', '/actors', lambda c, i: '/actors', 'get:actors'),
+        Case('GET /actors?limit=500', 'GET', '/actors', lambda c, i: '/actors?limit=500', 'get:actors'),
+        Case('GET /actors?sort=lastname&lastname_prefix', 'GET', '/actors',
+            lambda c, i: '/actors?sort=lastname&lastname_prefix=Lastname%200', 'get:actors'),
+        Case('GET /actors?ids', 'GET', '/actors',
+            lambda c, i: f'/actors?ids={ids(Context.actor_id)(c, i)}', 'get:actors'),
+        Case('GET /actors?stream=true', 'GET', '/actors', lambda c, i: '/actors?stream=true', 'get:actors'),
+        Case('POST /actors', 'POST', '/actors', lambda c, i: '/actors', 'post:actors',
+            body=lambda c, i: dict(actor_row(i), birthdate='1990-01-01')),
+        Case('POST /actors/bulk', 'POST', '/actors/bulk', lambda c, i: '/actors/bulk', 'post:actors',
+            body=lambda c, i: [ dict(actor_row(n), birthdate='1990-01-01') for n in range(BULK_SIZE) ]),
+        Case('PATCH /actors/bulk', 'PATCH', '/actors/bulk', lambda c, i: '/actors/bulk', 'patch:actors',
+            body=lambda c, i: [
+                { 'id': c.actor_id(i + n), 'changes': { 'stagename': f'Stagename {i} {n}' } }
+                for n in range(BULK_SIZE)
+            ]),
+        Case('GET /actors/<id>', 'GET', '/actors/<int:actor_id>',
+            lambda c, i: f'/actors/{c.actor_id(i)}', 'get:actors'),
+        Case('PATCH /actors/<id>', 'PATCH', '/actors/<int:actor_id>',
+            lambda c, i: f'/actors/{c.actor_id(i)}', 'patch:actors',
+            body=lambda c, i: { 'stagename': f'Stagename {i}' }),
+        Case('DELETE /actors/<id>', 'DELETE', '/actors/<int:actor_id>',
+            lambda c, i: f'/actors/{c.pools["actors"][i]}', 'delete:actors',
+            prepare=lambda c, count: c.fill_pool(Actor, actor_row, count)),
+        Case('GET /actors/<id>/movies', 'GET', '/actors/<int:actor_id>/movies',
+            lambda c, i: f'/actors/{c.actor_id(i)}/movies', 'get:actors'),
+        Case('POST /actors/<id>/movies', 'POST', '/actors/<int:actor_id>/movies',
+            lambda c, i: f'/actors/{c.actor_id(i)}/movies', 'patch:actors',
+            body=lambda c, i: { 'movies': [ c.movie_id(i + n) for n in range(CAST_SIZE) ] }),
+        Case('PUT /actors/<id>/movies', 'PUT', '/actors/<int:actor_id>/movies',
+            lambda c, i: f'/actors/{c.actor_id(i)}/movies', 'patch:actors',
+            body=lambda c, i: { 'movies': [ c.movie_id(i + n) for n in range(CAST_SIZE) ] }),
+        Case('DELETE /actors/<id>/movies', 'DELETE', '/actors/<int:actor_id>/movies',
+            lambda c, i: f'/actors/{c.actor_id(i)}/movies', 'patch:actors',
+            body=lambda c, i: { 'movies': [ c.movie_id(i) ] }),
+
+        Case('GET /movies', 'GET', '/movies', lambda c, i: '/movies', 'get:movies'),
+        Case('GET /movies?limit=500', 'GET', '/movies', lambda c, i: '/movies?limit=500', 'get:movies'),
+        Case('GET /movies?genre&sort=-year', 'GET', '/movies',
+            lambda c, i: '/movies?genre=Drama&sort=-year', 'get:movies'),
+        Case('GET /movies?ids', 'GET', '/movies',
+            lambda c, i: f'/movies?ids={ids(Context.movie_id)(c, i)}', 'get:movies'),
+        Case('GET /movies?stream=true', 'GET', '/movies', lambda c, i: '/movies?stream=true', 'get:movies'),
+        Case('POST /movies', 'POST', '/movies', lambda c, i: '/movies', 'post:movies',
+            body=lambda c, i: movie_row(i)),
+        Case('POST /movies/bulk', 'POST', '/movies/bulk', lambda c, i: '/movies/bulk', 'post:movies',
+            body=lambda c, i: [ movie_row(n) for n in range(BULK_SIZE) ]),
+        Case('PATCH /movies/bulk', 'PATCH', '/movies/bulk', lambda c, i: '/movies/bulk', 'patch:movies',
+            body=lambda c, i: [
+                { 'id': c.movie_id(i + n), 'changes': { 'title': f'Title {i} {n}' } }
+                for n in range(BULK_SIZE)
+            ]),
+        Case('GET /movies/<id>', 'GET', '/movies/<int:movie_id>',
+            lambda c, i: f'/movies/{c.movie_id(i)}', 'get:movies'),
+        Case('PATCH /movies/<id>', 'PATCH', '/movies/<int:movie_id>',
+            lambda c, i: f'/movies/{c.movie_id(i)}', 'patch:movies',
+            body=lambda c, i: { 'title': f'Title {i}' }),
+        Case('DELETE /movies/<id>', 'DELETE', '/movies/<int:movie_id>',
+            lambda c, i: f'/movies/{c.pools["movies"][i]}', 'delete:movies',
+            prepare=lambda c, count: c.fill_pool(Movie, movie_row, count)),
+        Case('GET /movies/<id>/actors', 'GET', '/movies/<int:movie_id>/actors',
+            lambda c, i: f'/movies/{c.movie_id(i)}/actors', 'get:movies'),
+        Case('POST /movies/<id>/actors', 'POST', '/movies/<int:movie_id>/actors',
+            lambda c, i: f'/movies/{c.movie_id(i)}/actors', 'patch:movies',
+            body=lambda c, i: { 'actors': [ c.actor_id(i + n) for n in range(CAST_SIZE) ] }),
+        Case('PUT /movies/<id>/actors', 'PUT', '/movies/<int:movie_id>/actors',
+            lambda c, i: f'/movies/{c.movie_id(i)}/actors', 'patch:movies',
+            body=lambda c, i: { 'actors': [ c.actor_id(i + n) for n in range(CAST_SIZE) ] }),
+        Case('DELETE /movies/<id>/actors', 'DELETE', '/movies/<int:movie_id>/actors',
+            lambda c, i: f'/movies/{c.movie_id(i)}/actors', 'patch:movies',
+            body=lambda c, i: { 'actors': [ c.actor_id(i) ] }),
+
+        Case('GET /stats', 'GET', '/stats', lambda c, i: '/stats', 'get:movies'),
+        Case('POST /stats/refresh', 'POST', '/stats/refresh', lambda c, i: '/stats/refresh', 'patch:movies'),
+
+        Case('GET /metrics', 'GET', '/metrics', lambda c, i: '/metrics'),
+        Case('GET /', 'GET', '/', lambda c, i: '/'),
+        Case('GET /coolkids', 'GET', '/coolkids', lambda c, i: '/coolkids')
+    ]
+
+# Routes of the app (rule, method) without a case: new routes must get one
+def get_missing_routes(app, cases):
+    covered = { (case.rule, case.method) for case in cases }
+    return sorted(
+        (rule.rule, method)
+        for rule in app.url_map.iter_rules() if rule.endpoint != 'static'
+        for method in rule.methods - { 'HEAD', 'OPTIONS' }
+        if (rule.rule, method) not in covered
+    )
+
+
+## Measures
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+'''
+run_case(client, context, case, stub, requests, concurrency, warmup) method
+    it should send warmup untimed requests, then requests timed ones split
+        across concurrency threads
+    it should read the whole body of every response (streams included)
+    return the result dict of the report
+'''
+def run_case(client, context, case, stub, requests, concurrency, warmup):
+    headers = {}
+    if case.permission:
+        headers['Authorization'] = f'Bearer {stub.mint_token([ case.permission ])}'
+    if case.prepare:
+        case.prepare(context, warmup + requests)
+
+    def send(i):
+        body = case.body(context, i) if case.body else None
+        start = time.perf_counter()
+        response = client.open(case.url(context, i), method=case.method, headers=headers, json=body)
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        response.close()
+        return elapsed, response.status_code
+
+    for i in range(warmup):
+        send(i)
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker(indexes):
+        for i in indexes:
+            elapsed, status = send(warmup + i)
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [
+        threading.Thread(target=worker, args=(range(n, requests, concurrency),))
+        for n in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    errors = sum(count for status, count in statuses.items() if status >= 400)
+    return {
+        'name': case.name,
+        'method': case.method,
+        'rule': case.rule,
+        'requests': requests,
+        'errors': errors,
+        'statuses': { str(status): count for status, count in sorted(statuses.items()) },
+        'throughput': round(requests / wall, 2),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3)
+    }
+
+def get_commit():
+    try:
+        return subprocess.run(
+            [ 'git', 'rev-parse', '--short', 'HEAD' ],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+'''
+run(args) method
+    it should start the JWKS stub and point auth at it
+    it should seed the database and run every case at each data size
+    it should refuse to run while a route of create_app has no case
+    return the report dict
+'''
+def run(args):
+    stub = JWKSStub(issuer=f'https://{ISSUER_DOMAIN}/', audience=AUDIENCE).start()
+    auth.JWKS_URL = stub.url
+    auth.AUTH0_DOMAIN = ISSUER_DOMAIN
+    auth.API_AUDIENCE = AUDIENCE
+    read_model.enabled = args.read_model
+
+    database_dir = None
+    database_url = args.database_url
+    if database_url is None:
+        database_dir = tempfile.TemporaryDirectory()
+        database_url = f'sqlite:///{database_dir.name}/benchmark.db'
+
+    app = create_app({ 'SQLALCHEMY_DATABASE_URI': database_url })
+    client = app.test_client()
+    cases = [
+        case for case in get_cases()
+        if not args.only or any(name in case.name for name in args.only)
+    ]
+    missing = get_missing_routes(app, get_cases())
+    if missing:
+        raise SystemExit(f'Routes without a benchmark case: {missing}')
+
+    with app.app_context():
+        dialect = db.engine.dialect.name
+
+    results = []
+    try:
+        for size in args.sizes:
+            context = Context(app, *seed(app, size))
+            read_model.reset()
+            auth.clear_token_cache()
+            for case in cases:
+                result = dict(size=size, **run_case(
+                    client, context, case, stub, args.requests, args.concurrency, args.warmup
+                ))
+                results.append(result)
+                print(
+                    f'{size:>7} {case.name:<45} {result["throughput"]:>9.1f} req/s'
+                    f' p50 {result["p50_ms"]:>8.2f} ms  p95 {result["p95_ms"]:>8.2f} ms'
+                    f'  p99 {result["p99_ms"]:>8.2f} ms  errors {result["errors"]}'
+                )
+    finally:
+        stub.stop()
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        if database_dir is not None:
+            database_dir.cleanup()
+
+    return {
+        'commit': get_commit(),
+        'date': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+        'python': platform.python_version(),
+        'database': dialect,
+        'read_model': args.read_model,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'results': results
+    }
+
+'''
+compare(baseline, report, max_regression) method
+    it should print, for the cases of both reports, the change of throughput and p95
+    return the list of (size, name) whose p95 grew by more than max_regression
+'''
+def compare(baseline, report, max_regression):
+    previous = { (result['size'], result['name']): result for result in baseline['results'] }
+    regressions = []
+    print(f'{baseline.get("commit")} -> {report.get("commit")}')
+    for result in report['results']:
+        key = (result['size'], result['name'])
+        if key not in previous:
+            continue
+        old = previous[key]
+        throughput = result['throughput'] / old['throughput'] - 1 if old['throughput'] else 0
+        p95 = result['p95_ms'] / old['p95_ms'] - 1 if old['p95_ms'] else 0
+        flag = ''
+        if p95 > max_regression:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print(
+            f'{result["size"]:>7} {result["name"]:<45} throughput {throughput:>+7.1%}'
+            f'  p95 {old["p95_ms"]:>8.2f} -> {result["p95_ms"]:>8.2f} ms ({p95:>+7.1%}){flag}'
+        )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the API routes')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmark and write a JSON report')
+    run_parser.add_argument('--sizes', type=lambda value: [ int(size) for size in value.split(',') ],
+        default=[ 100, 1000, 10000 ], help='rows of actors and of movies, comma separated')
+    run_parser.add_argument('--requests', type=int, default=200, help='timed requests per case')
+    run_parser.add_argument('--warmup', type=int, default=10, help='untimed requests per case')
+    run_parser.add_argument('--concurrency', type=int, default=1, help='threads sending the requests')
+    run_parser.add_argument('--database-url', help='database to use, EMPTIED at each size (default: a new SQLite file)')
+    run_parser.add_argument('--read-model', action='store_true', help='serve the GET routes from the read model')
+    run_parser.add_argument('--only', action='append', help='run only the cases whose name contains this text')
+    run_parser.add_argument('--output', help='path of the JSON report')
+    run_parser.add_argument('--compare', help='report to compare the new one with')
+    run_parser.add_argument('--max-regression', type=float, default=0.2, help='allowed p95 growth (0.2 = 20%%)')
+
+    compare_parser = commands.add_parser('compare', help='compare two JSON reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('report')
+    compare_parser.add_argument('--max-regression', type=float, default=0.2, help='allowed p95 growth (0.2 = 20%%)')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        report = run(args)
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(report, output, indent=2)
+        baseline_path = args.compare
+    else:
+        with open(args.report) as report_file:
+            report = json.load(report_file)
+        baseline_path = args.baseline
+
+    if baseline_path:
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(baseline, report, args.max_regression):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Libraries
+import os
+import sys
+import time
+import datetime
+import argparse
+import flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# App Modules
+import json_provider
+
+'''
+Micro-benchmark of the serialisation of GET /actors responses
+    python benchmarks/json_encoding.py [--actors 1000] [--repeat 200]
+It times, per response of --actors Actor.long() dicts:
+    flask.jsonify: the stdlib encoder of Flask (sorted keys, HTTP dates), used before
+    json: json_provider with the standard library fallback
+    orjson: json_provider with orjson, when it is installed
+'''
+
+def make_actors(count):
+    return [
+        {
+            'id': i,
+            'firstname': f'Firstname {i}',
+            'lastname': f'Lastname {i}',
+            'stagename': f'Stagename {i}',
+            'gender': 'female' if i % 2 else 'male',
+            'birthdate': datetime.date(1950, 1, 1) + datetime.timedelta(days=i)
+        } for i in range(count)
+    ]
+
+# Best time of repeat runs of function, in seconds
+def best_of(function, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serialisation cost of a list of actors')
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    app = flask.Flask(__name__)
+    body = { 'success': True, 'actors': make_actors(args.actors), 'total': args.actors }
+
+    encoders = { 'flask.jsonify': lambda: flask.jsonify(body) }
+    for name in json_provider.PROVIDERS:
+        if name == 'orjson' and json_provider.orjson is None:
+            continue
+        provider = json_provider.get_provider(name)
+        encoders[name] = lambda provider=provider: app.response_class(
+            provider.dumpb(body), mimetype='application/json'
+        )
+
+    with app.app_context():
+        baseline = None
+        print(f'{"encoder":<15} {"ms / " + str(args.actors) + " actors":>18} {"bytes":>9} {"speedup":>8}')
+        for name, encode in encoders.items():
+            seconds = best_of(encode, args.repeat)
+            size = len(encode().get_data())
+            baseline = baseline or seconds
+            print(f'{name:<15} {seconds * 1000:>18.3f} {size:>9} {baseline / seconds:>7.1f}x')
+
+if __name__ == '__main__':
+    main()
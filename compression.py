@@ -0,0 +1,188 @@
+# Libraries
+import os
+import zlib
+import threading
+from collections import OrderedDict
+from flask import request
+
+# App Modules
+from metrics import add_collector
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smallest body (bytes) worth compressing, smaller ones are sent as they are
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+# 1 (fastest) to 9 (smallest)
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+# 0 (fastest) to 11 (smallest), the higher ones are too slow for dynamic responses
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+# Bytes of compressed bodies kept in memory, by ETag and encoding (0 disables the cache)
+COMPRESSION_CACHE_SIZE = int(os.environ.get('COMPRESSION_CACHE_SIZE', 16 * 1024 * 1024))
+
+COMPRESSIBLE_MIMETYPES = ( 'application/json', 'application/x-ndjson', 'text/plain', 'text/html' )
+
+
+'''
+Compressed bodies cache
+    (etag, encoding): compressed bytes, least recently used first
+The ETag of a response changes with its table versions (see http_cache),
+so an entry is never stale, old ones are only evicted.
+'''
+_compression_cache = OrderedDict()
+_compression_cache_lock = threading.Lock()
+_compression_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'bytes': 0
+}
+
+def compression_cache_info():
+    with _compression_cache_lock:
+        return {
+            'hits': _compression_cache_stats['hits'],
+            'misses': _compression_cache_stats['misses'],
+            'size': len(_compression_cache),
+            'bytes': _compression_cache_stats['bytes'],
+            'maxbytes': COMPRESSION_CACHE_SIZE
+        }
+
+@add_collector
+def compression_cache_metrics():
+    info = compression_cache_info()
+    return [
+        ('cinema_compression_cache_hits_total', 'counter', 'Responses sent with a cached compressed body.', info['hits']),
+        ('cinema_compression_cache_misses_total', 'counter', 'Responses with an ETag compressed again.', info['misses']),
+        ('cinema_compression_cache_bytes', 'gauge', 'Bytes of compressed bodies in the cache.', info['bytes'])
+    ]
+
+# Empty the compressed bodies cache and reset its statistics
+def clear_compression_cache():
+    with _compression_cache_lock:
+        _compression_cache.clear()
+        _compression_cache_stats.update({
+            'hits': 0,
+            'misses': 0,
+            'bytes': 0
+        })
+
+def get_cached(key):
+    with _compression_cache_lock:
+        data = _compression_cache.get(key)
+        if data is None:
+            _compression_cache_stats['misses'] += 1
+            return None
+        _compression_cache.move_to_end(key)
+        _compression_cache_stats['hits'] += 1
+        return data
+
+def set_cached(key, data):
+    if len(data) > COMPRESSION_CACHE_SIZE:
+        return
+    with _compression_cache_lock:
+        previous = _compression_cache.pop(key, None)
+        if previous is not None:
+            _compression_cache_stats['bytes'] -= len(previous)
+        _compression_cache[key] = data
+        _compression_cache_stats['bytes'] += len(data)
+        while _compression_cache_stats['bytes'] > COMPRESSION_CACHE_SIZE:
+            key, evicted = _compression_cache.popitem(last=False)
+            _compression_cache_stats['bytes'] -= len(evicted)
+
+
+'''
+get_encoding() method
+    it should pick the encoding the client accepts with the highest quality,
+        brotli first on a tie (and only when the brotli module is installed)
+    return 'br', 'gzip' or None
+'''
+def get_encoding():
+    encodings = [ 'br', 'gzip' ] if brotli is not None else [ 'gzip' ]
+    return request.accept_encodings.best_match(encodings)
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+'''
+compress_stream(chunks, encoding) method
+    @INPUTS
+        chunks: iterable of the body chunks (bytes or str) of a streamed response
+        encoding: 'br' or 'gzip'
+
+    it should compress every chunk as it comes and flush it, so the client gets
+        each batch of rows without waiting for the whole body
+    return a generator of the compressed chunks
+'''
+def compress_stream(chunks, encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        process = compressor.compress
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+'''
+compress_response(response) method
+    @INPUTS
+        response: Flask response, from an after_request hook
+
+    it should add Vary: Accept-Encoding to every response that may be compressed
+    it should compress the 200 responses of a compressible type with the encoding
+        the client accepts, when they are at least COMPRESSION_MIN_SIZE bytes
+    it should reuse the compressed body of a response with an ETag
+    it should compress the streamed responses chunk by chunk, whatever their size
+    return the response
+'''
+def compress_response(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES and response.status_code != 304:
+        return response
+    response.vary.add('Accept-Encoding')
+
+    if (response.status_code != 200 or request.method == 'HEAD'
+            or 'Content-Encoding' in response.headers or response.direct_passthrough):
+        return response
+
+    encoding = get_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+
+    etag, weak = response.get_etag()
+    key = (etag, encoding)
+    compressed = get_cached(key) if etag and COMPRESSION_CACHE_SIZE else None
+    if compressed is None:
+        compressed = compress(data, encoding)
+        if etag and COMPRESSION_CACHE_SIZE:
+            set_cached(key, compressed)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
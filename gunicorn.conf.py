@@ -0,0 +1,89 @@
+# Libraries
+import os
+
+'''
+gunicorn configuration
+    gunicorn -c gunicorn.conf.py app:app
+Every setting can be overridden with the environment variables below.
+'''
+
+# Number of CPUs this process can run on (the container quota, not the host)
+def get_cpu_count():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+cpu_count = get_cpu_count()
+
+# Enough threads for both admission budgets and one of their queues
+def get_default_threads():
+    from admission import (ADMISSION_CONTROL, READ_CONCURRENCY, WRITE_CONCURRENCY,
+        ADMISSION_QUEUE_SIZE)
+    if not ADMISSION_CONTROL:
+        return min(cpu_count * 2, 8)
+    return READ_CONCURRENCY + WRITE_CONCURRENCY + ADMISSION_QUEUE_SIZE
+
+# Heroku sets PORT
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+# Threaded workers: a slow request (or a JWKS fetch) only blocks its own thread
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# WEB_CONCURRENCY is also the Heroku convention for the number of processes
+workers = int(os.environ.get('WEB_CONCURRENCY', cpu_count * 2 + 1))
+# Threads running requests plus threads waiting in the admission queues (see admission.py),
+# the admission budgets keep the running ones <= DB_POOL_SIZE + DB_MAX_OVERFLOW
+threads = int(os.environ.get('GUNICORN_THREADS', get_default_threads()))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Load the app once in the master: the workers share its memory copy-on-write
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+'''
+when_ready(server) hook
+    runs in the master after the app is loaded, before the first fork
+    it should fill the caches the workers inherit (JWKS keys, read model snapshot)
+    it should close the database connections opened so far (primary and replicas),
+        no worker may reuse them
+'''
+def when_ready(server):
+    if not preload_app:
+        return
+
+    from auth import warm_jwks
+    from models import db, dispose_engines
+    from read_model import read_model
+
+    if warm_jwks():
+        server.log.info('JWKS keys cached before forking')
+
+    app = server.app.wsgi()
+    with app.app_context():
+        if read_model.enabled:
+            try:
+                read_model.rebuild()
+                server.log.info('Read model snapshot built before forking')
+            except Exception as error:
+                server.log.warning(f'Read model warm up error: {error}')
+            db.session.remove()
+        dispose_engines(app)
+
+'''
+post_fork(server, worker) hook
+    runs in each worker after the fork
+    it should start the worker with an empty connection pool: a connection
+        shared by two processes corrupts both sessions
+'''
+def post_fork(server, worker):
+    if not preload_app:
+        return
+
+    from models import db, dispose_engines
+
+    app = server.app.wsgi()
+    with app.app_context():
+        db.session.remove()
+        dispose_engines(app)
@@ -0,0 +1,83 @@
+# Libraries
+import hashlib
+import datetime
+from functools import wraps
+from flask import request, make_response
+
+# App Modules
+from models import get_versions
+from read_model import read_model
+
+'''
+get_etag(versions) method
+    @INPUTS
+        versions: {table: (version, updated_at)} of the tables the response is built from
+
+    the tag changes when any of the tables is written, and differs between
+    representations of the same data (url, query string, Accept header)
+    return a weak ETag value
+'''
+def get_etag(versions):
+    key = '|'.join(
+        [ request.full_path, request.headers.get('Accept', '') ] +
+        [ f'{name}={version}' for name, (version, updated_at) in sorted(versions.items()) ]
+    )
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+# Most recent write to the tables, in UTC
+def get_last_modified(versions):
+    dates = [ updated_at for version, updated_at in versions.values() if updated_at ]
+    if not dates:
+        return None
+    return max(dates).replace(microsecond=0, tzinfo=datetime.timezone.utc)
+
+# Check if the client copy, described by the conditional headers, is still valid
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= request.if_modified_since
+    return False
+
+'''
+@conditional(*tables) decorator method
+    @INPUTS
+        tables: names of the tables the response is built from
+
+    it should look up the versions of the tables before running the route
+        (a write in between only makes the next request miss)
+        from the read model snapshot when it is enabled, from the db otherwise
+    it should answer 304 Not Modified, without running the route, when the
+        If-None-Match / If-Modified-Since headers match the current versions
+    it should add the ETag and Last-Modified headers to the 200 responses
+    return the decorator
+'''
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if read_model.enabled:
+                versions = read_model.versions(*tables)
+            else:
+                versions = get_versions(*tables)
+            etag = get_etag(versions)
+            last_modified = get_last_modified(versions)
+
+            if is_not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            # clients can keep the response but must revalidate it
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        return wrapper
+
+    return conditional_decorator
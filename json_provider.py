@@ -0,0 +1,131 @@
+# Libraries
+import os
+import abc
+import json
+import decimal
+import time
+import datetime
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# App Modules
+from metrics import record_phase
+
+# 'orjson' (when it is installed) or 'json', the standard library encoder
+JSON_PROVIDER = os.environ.get('JSON_PROVIDER', 'orjson' if orjson is not None else 'json')
+
+
+'''
+default(value) method
+    @INPUTS
+        value: object the encoder cannot serialize by itself
+
+    it should give dates as ISO 8601 strings (i.e. 2000-04-03), as the API accepts them
+    it should raise a TypeError for the other types
+    return a serializable value
+'''
+def default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+'''
+JSONProvider
+Compact JSON encoding of the responses (no indentation, no spaces, keys in insertion order)
+    dumps(obj): str, i.e. for a streamed chunk
+    dumpb(obj): UTF-8 bytes, the body of a response
+    loads(data): parsed str or bytes
+    a provider without dumpb or loads can not be instantiated
+'''
+class JSONProvider(abc.ABC):
+    name = None
+
+    def dumps(self, obj):
+        return self.dumpb(obj).decode('utf-8')
+
+    @abc.abstractmethod
+    def dumpb(self, obj):
+        pass
+
+    @abc.abstractmethod
+    def loads(self, data):
+        pass
+
+class StdlibJSONProvider(JSONProvider):
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':'))
+
+    def dumpb(self, obj):
+        return self.dumps(obj).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+class OrjsonJSONProvider(JSONProvider):
+    name = 'orjson'
+
+    def dumpb(self, obj):
+        # dates are encoded natively in ISO 8601, default only sees the other types
+        return orjson.dumps(obj, default=default)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+PROVIDERS = {
+    'json': StdlibJSONProvider,
+    'orjson': OrjsonJSONProvider
+}
+
+'''
+get_provider(name) method
+    @INPUTS
+        name: key of PROVIDERS
+
+    it should fall back to the standard library when orjson is not installed
+    return a JSONProvider
+'''
+def get_provider(name):
+    if name not in PROVIDERS:
+        raise ValueError(f'JSON_PROVIDER must be one of: {", ".join(PROVIDERS)}.')
+    if name == 'orjson' and orjson is None:
+        print('orjson is not installed, using the json module')
+        name = 'json'
+    return PROVIDERS[name]()
+
+provider = get_provider(JSON_PROVIDER)
+
+
+def dumps(obj):
+    return provider.dumps(obj)
+
+def loads(data):
+    return provider.loads(data)
+
+'''
+jsonify(*args, **kwargs) method
+    same arguments as flask.jsonify, encoded by the provider
+    return an application/json response
+'''
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+
+    start = time.perf_counter()
+    body = provider.dumpb(data)
+    record_phase('serialize', time.perf_counter() - start)
+    return current_app.response_class(body, mimetype='application/json')
@@ -0,0 +1,148 @@
+# Libraries
+import json
+import time
+import uuid
+import base64
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+'''
+Local stand-in for the Auth0 JWKS endpoint
+
+It generates RSA signing keys, serves them on /.well-known/jwks.json and mints
+RS256 tokens signed with them, so the API can be tested without Auth0:
+
+    stub = JWKSStub(issuer='https://example.auth0.com/', audience='cinema')
+    stub.start()
+    auth.JWKS_URL = stub.url
+    token = stub.mint_token(['get:actors'])
+    ...
+    stub.stop()
+'''
+
+# Convert an int to base64 (url safe, no padding)
+def int_to_base64url(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('utf-8')
+
+# Generate an RSA private key and its JWK (public part)
+def generate_key(kid=None):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    numbers = private_key.public_key().public_numbers()
+    jwk = {
+        'kty': 'RSA',
+        'use': 'sig',
+        'alg': 'RS256',
+        'kid': kid or uuid.uuid4().hex,
+        'e': int_to_base64url(numbers.e),
+        'n': int_to_base64url(numbers.n)
+    }
+    return private_key, jwk
+
+
+class JWKSRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connections alive like the real endpoint
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.requests += 1
+
+        if stub.delay:
+            time.sleep(stub.delay)
+
+        if self.path != '/.well-known/jwks.json':
+            self.send_error(404)
+            return
+        if stub.fail:
+            self.send_error(503)
+            return
+
+        body = json.dumps({ 'keys': stub.jwks() }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if stub.cache_control:
+            self.send_header('Cache-Control', stub.cache_control)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def setup(self):
+        super().setup()
+        self.server.stub.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class JWKSStub:
+    def __init__(self, issuer, audience, host='127.0.0.1', port=0):
+        self.issuer = issuer
+        self.audience = audience
+        self.host = host
+        self.port = port
+        self.keys = []
+        # behaviour of the endpoint, can be changed while it runs
+        self.cache_control = 'public, max-age=600'
+        self.delay = 0
+        self.fail = False
+        # counters
+        self.requests = 0
+        self.connections = 0
+        self.server = None
+        self.thread = None
+        self.rotate()
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/.well-known/jwks.json'
+
+    # JWKS keys currently published
+    def jwks(self):
+        return [ jwk for private_key, jwk in self.keys ]
+
+    # Publish a new signing key, keep the previous ones unless replace is set
+    def rotate(self, replace=False):
+        key = generate_key()
+        if replace:
+            self.keys = [ key ]
+        else:
+            self.keys = [ key ] + self.keys
+        return key[1]['kid']
+
+    # Sign a token with the newest key
+    def mint_token(self, permissions, expires_in=3600, subject='auth0|stub', **claims):
+        private_key, jwk = self.keys[0]
+        now = int(time.time())
+        payload = {
+            'iss': self.issuer,
+            'sub': subject,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        payload.update(claims)
+        return jwt.encode(
+            payload,
+            private_key,
+            algorithm='RS256',
+            headers={ 'kid': jwk['kid'] }
+        )
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), JWKSRequestHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
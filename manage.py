@@ -2,7 +2,7 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, create_schema
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +10,11 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+# Create the missing tables without the migrations (i.e. a new local database)
+@manager.command
+def create_db():
+    create_schema(app)
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
@@ -0,0 +1,211 @@
+# Libraries
+import os
+import hmac
+import time
+import bisect
+import threading
+from flask import g, request, has_request_context, abort
+
+# Add the Server-Timing header to the responses
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() == 'true'
+# Serve /metrics only with the 'Authorization: Bearer <METRICS_TOKEN>' header, when set
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Phases of a request, in the order of the Server-Timing header
+PHASES = ('auth', 'db', 'serialize')
+
+
+# Escape a Prometheus label value
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+'''
+Histogram
+Prometheus histogram of durations (seconds), one series per tuple of label values
+    observe() costs a bisect and a short lock, so it can stay on in production
+    the counts are per process: every gunicorn worker exposes its own
+'''
+class Histogram:
+    def __init__(self, name, documentation, labelnames, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values: [count per bucket (not cumulative) and +Inf, sum]
+        self.series = {}
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [ [ 0 ] * (len(self.buckets) + 1), 0.0 ]
+            series[0][index] += 1
+            series[1] += value
+
+    def clear(self):
+        with self.lock:
+            self.series = {}
+
+    def collect(self):
+        with self.lock:
+            series = { labels: (list(counts), total) for labels, (counts, total) in self.series.items() }
+
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} histogram'
+        ]
+        names = self.labelnames + ('le',)
+        for labels, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+'''
+Counter
+Prometheus counter, one series per tuple of label values
+'''
+class Counter:
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, labels, value=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + value
+
+    def clear(self):
+        with self.lock:
+            self.series = {}
+
+    def collect(self):
+        with self.lock:
+            series = dict(self.series)
+
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} counter'
+        ]
+        for labels, value in sorted(series.items()):
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+request_duration = Histogram(
+    'cinema_request_duration_seconds',
+    'Duration of the requests, until the response headers.',
+    [ 'route', 'method', 'status' ]
+)
+request_phase_duration = Histogram(
+    'cinema_request_phase_duration_seconds',
+    'Time spent by the requests in each phase (auth, db, serialize).',
+    [ 'route', 'method', 'status', 'phase' ]
+)
+_metrics = [ request_duration, request_phase_duration ]
+
+# Callbacks returning [(name, type, help, value)] samples, read on every scrape
+_collectors = []
+
+'''
+add_collector(callback)
+    registers a callback() returning a list of (name, type, help, value) tuples,
+    type being 'counter' or 'gauge', added to /metrics on every scrape
+'''
+def add_collector(callback):
+    _collectors.append(callback)
+    return callback
+
+# Register a Histogram or a Counter to /metrics
+def add_metric(metric):
+    _metrics.append(metric)
+    return metric
+
+# Empty the histograms and the counters
+def clear_metrics():
+    for metric in _metrics:
+        metric.clear()
+
+
+'''
+record_phase(phase, seconds) method
+    adds seconds to a phase of the current request, does nothing outside a request
+'''
+def record_phase(phase, seconds):
+    if has_request_context():
+        timings = g.get('timings')
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0.0) + seconds
+
+# before_request hook: start the timers of the request
+def start_request():
+    g.request_start = time.perf_counter()
+    g.timings = {}
+
+'''
+finish_request(response) method
+    after_request hook, registered before the other ones so it runs last
+    it should observe the duration of the request and of each phase,
+        labelled by route (the url rule, not the url), method and status
+    it should add the Server-Timing header (milliseconds)
+    streamed bodies are sent after it: their time is not included
+    return the response
+'''
+def finish_request(response):
+    start = g.pop('request_start', None)
+    timings = g.pop('timings', None)
+    if start is None:
+        return response
+    total = time.perf_counter() - start
+
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    labels = (route, request.method, str(response.status_code))
+    request_duration.observe(labels, total)
+    for phase in PHASES:
+        if phase in timings:
+            request_phase_duration.observe(labels + (phase,), timings[phase])
+
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = ', '.join(
+            [ f'{phase};dur={timings[phase] * 1000:.2f}' for phase in PHASES if phase in timings ] +
+            [ f'total;dur={total * 1000:.2f}' ]
+        )
+    return response
+
+# Check the METRICS_TOKEN of the /metrics request, if one is configured
+def check_metrics_token():
+    if not METRICS_TOKEN:
+        return
+    expected = f'Bearer {METRICS_TOKEN}'
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+        abort(401, 'The metrics token is missing or wrong.')
+
+'''
+render_metrics() method
+    return the histograms, the counters and the collectors samples in the Prometheus text format
+'''
+def render_metrics():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.collect())
+    for collector in _collectors:
+        for name, metric_type, documentation, value in collector():
+            lines.extend([
+                f'# HELP {name} {documentation}',
+                f'# TYPE {name} {metric_type}',
+                f'{name} {value}'
+            ])
+    return '\n'.join(lines) + '\n'
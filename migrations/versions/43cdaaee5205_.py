@@ -0,0 +1,53 @@
+"""recitations primary key and indexes of the hot query paths
+
+Revision ID: 43cdaaee5205
+Revises: 4524cba4c595
+Create Date: 2026-10-17 11:40:03.218764
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '43cdaaee5205'
+down_revision = '4524cba4c595'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the primary key needs unique, not null links: drop the incomplete and duplicated ones
+    op.execute('DELETE FROM recitations WHERE movie_id IS NULL OR actor_id IS NULL')
+    op.execute(
+        'CREATE TABLE recitations_distinct AS '
+        'SELECT DISTINCT movie_id, actor_id FROM recitations'
+    )
+    op.execute('DELETE FROM recitations')
+    op.execute(
+        'INSERT INTO recitations (movie_id, actor_id) '
+        'SELECT movie_id, actor_id FROM recitations_distinct'
+    )
+    op.drop_table('recitations_distinct')
+
+    with op.batch_alter_table('recitations') as batch_op:
+        batch_op.alter_column('movie_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('actor_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('recitations_pkey', ['movie_id', 'actor_id'])
+        batch_op.create_index('ix_recitations_actor_id_movie_id', ['actor_id', 'movie_id'], unique=False)
+
+    op.create_index(op.f('ix_movies_year'), 'movies', ['year'], unique=False)
+    op.create_index(op.f('ix_movies_genre'), 'movies', ['genre'], unique=False)
+    op.create_index(op.f('ix_actors_lastname'), 'actors', ['lastname'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_actors_lastname'), table_name='actors')
+    op.drop_index(op.f('ix_movies_genre'), table_name='movies')
+    op.drop_index(op.f('ix_movies_year'), table_name='movies')
+
+    with op.batch_alter_table('recitations') as batch_op:
+        batch_op.drop_index('ix_recitations_actor_id_movie_id')
+        batch_op.drop_constraint('recitations_pkey', type_='primary')
+        batch_op.alter_column('actor_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('movie_id', existing_type=sa.Integer(), nullable=True)
@@ -0,0 +1,36 @@
+"""table versions for conditional GETs
+
+Revision ID: 4524cba4c595
+Revises: c1a4b256151a
+Create Date: 2026-10-17 09:12:41.503128
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4524cba4c595'
+down_revision = 'c1a4b256151a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('table_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # seed the rows, so concurrent first writes only update them
+    op.execute(
+        "INSERT INTO table_versions (name, version, updated_at) VALUES "
+        "('actors', 1, CURRENT_TIMESTAMP), "
+        "('movies', 1, CURRENT_TIMESTAMP), "
+        "('recitations', 1, CURRENT_TIMESTAMP)"
+    )
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,31 @@
+"""catalogue statistics summary
+
+Revision ID: 7d2f0c9b1e64
+Revises: 43cdaaee5205
+Create Date: 2026-10-17 16:05:22.914310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2f0c9b1e64'
+down_revision = '43cdaaee5205'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # filled by the first GET /stats (or POST /stats/refresh)
+    op.create_table('catalogue_stats',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('versions', sa.String(), nullable=False),
+    sa.Column('refreshed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('catalogue_stats')
@@ -1,24 +1,416 @@
 import os
-from sqlalchemy import Column, Integer, String, Date, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import time
+import datetime
+import threading
+from sqlalchemy import Column, Integer, String, Text, Date, DateTime, create_engine, event, text
+from sqlalchemy import select, exists, literal, case
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import orm
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
-database_path = os.environ['DATABASE_URL']
-if database_path.startswith("postgres://"):
-  database_path = database_path.replace("postgres://", "postgresql://", 1)
+from metrics import add_collector
 
-db = SQLAlchemy()
+# Connection pool of each worker process (not used with SQLite)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# Seconds a request waits for a free connection before failing
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Seconds after which a connection is replaced, -1 to keep it forever
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# Test each connection on checkout, so the ones closed by a failover are replaced
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# Milliseconds a statement can run on Postgres before it is cancelled, 0 for no limit
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))
+
+# SQLALCHEMY_BINDS key of the read replicas: replica_0, replica_1...
+REPLICA_BIND_PREFIX = 'replica_'
+# Seconds a connection to a Postgres replica may take to open, 0 for no limit
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+
+
+
+# Callback returning the engine of the reads of the current request, None for the primary
+_read_bind = None
+
+'''
+set_read_bind(callback)
+    registers the callback() choosing the engine of the reads (see replicas.py)
+'''
+def set_read_bind(callback):
+  global _read_bind
+  _read_bind = callback
+  return callback
+
+'''
+RoutingSession
+    sends the reads to the engine of set_read_bind, when it returns one,
+    the flushes and the INSERT / UPDATE / DELETE statements always to the primary
+'''
+class RoutingSession(SignallingSession):
+  def get_bind(self, mapper=None, clause=None, **kwargs):
+    if _read_bind is not None and not self._flushing and not getattr(clause, 'is_dml', False):
+      engine = _read_bind()
+      if engine is not None:
+        return engine
+    return SignallingSession.get_bind(self, mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
+
+
+# Checkout counters of the connection pools of this process
+_pool_stats = {
+  'checkouts': 0,
+  'waits': 0,
+  'timeouts': 0,
+  'wait_seconds': 0.0,
+  'max_wait_seconds': 0.0
+}
+_pool_stats_lock = threading.Lock()
+
+'''
+TimedQueuePool
+QueuePool that records how long each checkout waited for a connection
+    waits: checkouts that found the pool and its overflow exhausted
+    timeouts: checkouts that gave up after DB_POOL_TIMEOUT seconds
+'''
+class TimedQueuePool(QueuePool):
+  def _do_get(self):
+    exhausted = (self._max_overflow > -1 and self.checkedin() == 0
+      and self._overflow >= self._max_overflow)
+    start = time.perf_counter()
+    timed_out = False
+    try:
+      return super()._do_get()
+    except PoolTimeoutError:
+      timed_out = True
+      print(f'Connection pool exhausted: no connection after {self._timeout}s '
+        f'(size {self.size()}, overflow {self.overflow()})')
+      raise
+    finally:
+      wait = time.perf_counter() - start
+      with _pool_stats_lock:
+        _pool_stats['checkouts'] += 1
+        _pool_stats['waits'] += int(exhausted)
+        _pool_stats['timeouts'] += int(timed_out)
+        _pool_stats['wait_seconds'] += wait
+        _pool_stats['max_wait_seconds'] = max(_pool_stats['max_wait_seconds'], wait)
+
+'''
+get_pool_stats()
+    returns the checkout counters and the current state of the pool
+    (size, checked out connections, overflow)
+'''
+def get_pool_stats():
+  with _pool_stats_lock:
+    stats = dict(_pool_stats)
+  pool = db.engine.pool
+  if isinstance(pool, QueuePool):
+    stats.update(
+      size=pool.size(),
+      checked_out=pool.checkedout(),
+      overflow=max(pool.overflow(), 0)
+    )
+  return stats
+
+@add_collector
+def pool_metrics():
+  stats = get_pool_stats()
+  metrics = [
+    ('cinema_db_pool_checkouts_total', 'counter', 'Connections checked out of the pool.', stats['checkouts']),
+    ('cinema_db_pool_waits_total', 'counter', 'Checkouts that found the pool exhausted and waited.', stats['waits']),
+    ('cinema_db_pool_timeouts_total', 'counter', 'Checkouts that gave up after DB_POOL_TIMEOUT.', stats['timeouts']),
+    ('cinema_db_pool_wait_seconds_total', 'counter', 'Time spent waiting for a connection.', stats['wait_seconds']),
+    ('cinema_db_pool_max_wait_seconds', 'gauge', 'Longest wait for a connection.', stats['max_wait_seconds'])
+  ]
+  for key in [ 'size', 'checked_out', 'overflow' ]:
+    if key in stats:
+      metrics.append((f'cinema_db_pool_{key}', 'gauge', f'Current {key.replace("_", " ")} of the pool.', stats[key]))
+  return metrics
+
+'''
+get_engine_options(database_path)
+    returns the create_engine options of the database
+    SQLite keeps the SQLAlchemy defaults, it has no server connections to pool
+'''
+def get_engine_options(database_path):
+  if database_path.startswith('sqlite'):
+    return {}
+
+  options = {
+    'poolclass': TimedQueuePool,
+    'pool_size': DB_POOL_SIZE,
+    'max_overflow': DB_MAX_OVERFLOW,
+    'pool_timeout': DB_POOL_TIMEOUT,
+    'pool_recycle': DB_POOL_RECYCLE,
+    'pool_pre_ping': DB_POOL_PRE_PING
+  }
+  if database_path.startswith('postgresql') and DB_STATEMENT_TIMEOUT > 0:
+    options['connect_args'] = {
+      'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+    }
+  return options
+
+# Heroku still sets the postgres:// scheme, SQLAlchemy only accepts postgresql://
+def fix_scheme(database_path):
+  if database_path.startswith("postgres://"):
+    database_path = database_path.replace("postgres://", "postgresql://", 1)
+  return database_path
+
+'''
+get_database_path()
+    reads DATABASE_URL when the app is created, not when the module is imported
+'''
+def get_database_path():
+  return fix_scheme(os.environ['DATABASE_URL'])
+
+'''
+get_replica_paths()
+    reads DATABASE_REPLICA_URLS (comma separated), an empty list when it is not set
+'''
+def get_replica_paths():
+  paths = os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+  return [ fix_scheme(path.strip()) for path in paths if path.strip() ]
+
+'''
+get_replica_path(path)
+    adds REPLICA_CONNECT_TIMEOUT to the URL of a Postgres replica, unless it sets one:
+        an unreachable replica fails its health check quickly instead of hanging
+'''
+def get_replica_path(path):
+  url = make_url(path)
+  if url.get_backend_name() != 'postgresql' or REPLICA_CONNECT_TIMEOUT <= 0 or 'connect_timeout' in url.query:
+    return path
+  url = url.update_query_dict({ 'connect_timeout': str(REPLICA_CONNECT_TIMEOUT) })
+  return url.render_as_string(hide_password=False)
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the read replicas are the REPLICA_BIND_PREFIX binds, no table is bound to them:
+        only RoutingSession sends them the reads
+    it does not connect: the pool opens the first connection on the first query
+    the schema is managed by the migrations (or create_schema)
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None, replica_paths=None):
+  if database_path is None:
+    database_path = get_database_path()
+  if replica_paths is None:
+    replica_paths = get_replica_paths()
   app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+  app.config["SQLALCHEMY_BINDS"] = {
+    f'{REPLICA_BIND_PREFIX}{index}': get_replica_path(path) for index, path in enumerate(replica_paths)
+  }
   app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+  app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(database_path)
   db.app = app
   db.init_app(app)
-  db.create_all()
+
+'''
+dispose_engines(app)
+    closes the pooled connections of the primary and of the replicas
+'''
+def dispose_engines(app):
+  for bind in [ None ] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+    db.get_engine(app, bind).dispose()
+
+'''
+create_schema(app)
+    creates the missing tables of the models, i.e. for a new local or test database
+'''
+def create_schema(app):
+  with app.app_context():
+    db.create_all()
+
+
+'''
+"table_versions" Table
+    one row per data table, bumped in the same transaction of every write to it
+    it lets the API answer conditional GETs without reading the table itself
+'''
+class TableVersion(db.Model):
+  __tablename__ = 'table_versions'
+
+  name = Column(String, primary_key=True)
+  version = Column(Integer, nullable=False, default=0)
+  updated_at = Column(DateTime, nullable=False)
+
+
+'''
+"catalogue_stats" Table
+    aggregates of the catalogue (JSON), computed by stats.refresh_stats
+    versions: table versions they were computed from, i.e. actors=3,movies=5,recitations=2
+'''
+class CatalogueStats(db.Model):
+  __tablename__ = 'catalogue_stats'
+
+  name = Column(String, primary_key=True)
+  data = Column(Text, nullable=False)
+  versions = Column(String, nullable=False)
+  refreshed_at = Column(DateTime, nullable=False)
+
+  def get_data(self):
+    return json.loads(self.data)
+
+# Postgres channel notified of the committed writes (payload: comma separated table names)
+WRITE_CHANNEL = 'table_versions'
+
+# Callbacks called in this process with the set of written table names after each commit
+_write_listeners = []
+
+'''
+add_write_listener(callback)
+    registers a callback(table_names) called after a commit that bumped table versions
+'''
+def add_write_listener(callback):
+  _write_listeners.append(callback)
+  return callback
+
+@event.listens_for(db.session, 'after_commit')
+def call_write_listeners(session):
+  names = session.info.pop('written_tables', None)
+  if names:
+    for callback in _write_listeners:
+      callback(names)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_written_tables(session):
+  session.info.pop('written_tables', None)
+
+
+'''
+bump_version(*names)
+    increments the version of the given tables in the current transaction
+    on Postgres it also notifies WRITE_CHANNEL, delivered to the other processes on commit
+    the caller commits
+'''
+def bump_version(*names):
+  table = TableVersion.__table__
+  now = datetime.datetime.utcnow()
+  names = sorted(set(names))
+  db.session.info.setdefault('written_tables', set()).update(names)
+  if db.engine.dialect.name == 'postgresql':
+    db.session.execute(
+      text('SELECT pg_notify(:channel, :payload)'),
+      { 'channel': WRITE_CHANNEL, 'payload': ','.join(names) }
+    )
+  for name in names:
+    result = db.session.execute(
+      table.update()
+      .where(table.c.name == name)
+      .values(version=table.c.version + 1, updated_at=now)
+    )
+    if result.rowcount == 0:
+      db.session.execute(
+        table.insert().values(name=name, version=1, updated_at=now)
+      )
+
+
+'''
+get_versions(*names)
+    returns {name: (version, updated_at)} of the given tables
+    tables that were never written have version 0 and updated_at None
+'''
+def get_versions(*names):
+  table = TableVersion.__table__
+  rows = db.session.execute(
+    table.select().where(table.c.name.in_(names))
+  )
+  versions = { name: (0, None) for name in names }
+  for row in rows:
+    versions[row.name] = (row.version, row.updated_at)
+  return versions
+
+
+# Bound parameters of a SQLite statement (the limit of the SQLite versions before 3.32)
+SQLITE_MAX_VARIABLES = 999
+
+'''
+bulk_insert(model, rows)
+    inserts the rows (list of dicts with the same columns) in one transaction
+    uses a single multi-row INSERT ... RETURNING where the database supports it,
+        a few multi-row INSERTs on SQLite
+    returns the new ids in the order of the rows
+'''
+def bulk_insert(model, rows):
+  if not rows:
+    return []
+
+  table = model.__table__
+  try:
+    if db.engine.dialect.full_returning:
+      result = db.session.execute(
+        table.insert().values(rows).returning(table.c.id)
+      )
+      # ids come from a sequence, so they follow the order of the VALUES list
+      ids = sorted(row.id for row in result)
+    elif db.engine.dialect.name == 'sqlite':
+      # multi-row INSERTs within the bound parameters limit of SQLite: in the write
+      # transaction the new rowids are consecutive, up to the lastrowid of the batch
+      batch_size = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+      ids = []
+      for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        last_id = db.session.execute(table.insert().values(batch)).lastrowid
+        ids.extend(range(last_id - len(batch) + 1, last_id + 1))
+    else:
+      ids = [
+        db.session.execute(table.insert().values(**row)).inserted_primary_key[0]
+        for row in rows
+      ]
+    bump_version(model.__tablename__)
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+    raise
+
+  return ids
+
+
+'''
+bulk_update(model, changes)
+    changes: {id: {column: value}}, each id with its own columns and values
+    applies them with one UPDATE ... SET column = CASE id WHEN ... END WHERE id IN (...)
+    in one transaction, whatever the number of rows
+    returns the ids that do not exist (not updated), in the order of changes
+'''
+def bulk_update(model, changes):
+  if not changes:
+    return []
+
+  table = model.__table__
+  ids = list(changes)
+  columns = sorted(set(column for values in changes.values() for column in values))
+  statement = table.update().where(table.c.id.in_(ids)).values({
+    column: case(
+      { row_id: values[column] for row_id, values in changes.items() if column in values },
+      value=table.c.id,
+      else_=table.c[column]
+    ) for column in columns
+  })
+  try:
+    if db.engine.dialect.full_returning:
+      # the updated ids: a row deleted since the request was sent is reported missing
+      found = set(row.id for row in db.session.execute(statement.returning(table.c.id)))
+      missing_ids = [ row_id for row_id in ids if row_id not in found ]
+    else:
+      missing_ids = get_missing_ids(model, ids)
+      db.session.execute(statement)
+    if len(missing_ids) < len(ids):
+      bump_version(model.__tablename__)
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+    raise
+
+  return missing_ids
 
 
 '''
@@ -26,11 +418,129 @@ def setup_db(app, database_path=database_path):
 '''
 recitations = db.Table(
     'recitations',
-    db.Column('movie_id', db.Integer, db.ForeignKey('movies.id')),
-    db.Column('actor_id', db.Integer, db.ForeignKey('actors.id'))
+    db.Column('movie_id', db.Integer, db.ForeignKey('movies.id'), primary_key=True),
+    db.Column('actor_id', db.Integer, db.ForeignKey('actors.id'), primary_key=True),
+    # the primary key serves the lookups by movie, this index the ones by actor
+    db.Index('ix_recitations_actor_id_movie_id', 'actor_id', 'movie_id')
 )
 
 
+'''
+Casting helpers on the "recitations" Table
+    owner_key is 'movie_id' to change the cast of a movie,
+    'actor_id' to change the filmography of an actor
+    each helper runs a few set-based statements and commits once
+'''
+def get_linked_model(owner_key):
+  if owner_key == 'movie_id':
+    return 'actor_id', Actor
+  return 'movie_id', Movie
+
+'''
+get_links(owner_key, owner_id)
+    returns the sorted ids linked to the owner
+'''
+def get_links(owner_key, owner_id):
+  other_key, other_model = get_linked_model(owner_key)
+  rows = db.session.execute(
+    select(recitations.c[other_key])
+    .where(recitations.c[owner_key] == owner_id)
+    .where(recitations.c[other_key].isnot(None))
+    .distinct()
+  )
+  return sorted(row[0] for row in rows)
+
+'''
+get_missing_ids(model, ids)
+    returns the ids that do not exist in the model table, in the given order
+'''
+def get_missing_ids(model, ids):
+  table = model.__table__
+  found = set(
+    row[0] for row in db.session.execute(
+      select(table.c.id).where(table.c.id.in_(ids))
+    )
+  )
+  return [ row_id for row_id in ids if row_id not in found ]
+
+# INSERT ... SELECT of the links not present yet, skipping the ids that do not exist
+def insert_links(owner_key, owner_id, other_ids):
+  other_key, other_model = get_linked_model(owner_key)
+  other_table = other_model.__table__
+  statement = recitations.insert()
+  if db.engine.dialect.name == 'postgresql':
+    # a concurrent request may insert the same link between the SELECT and the INSERT
+    statement = postgresql.insert(recitations).on_conflict_do_nothing()
+  db.session.execute(
+    statement.from_select(
+      [ owner_key, other_key ],
+      select(literal(owner_id, Integer), other_table.c.id)
+      .where(other_table.c.id.in_(other_ids))
+      .where(~exists().where(
+        (recitations.c[owner_key] == owner_id) &
+        (recitations.c[other_key] == other_table.c.id)
+      ))
+    )
+  )
+
+'''
+add_links(owner_key, owner_id, other_ids)
+    links the owner to the ids, already linked and missing ids are skipped
+    returns the missing ids
+'''
+def add_links(owner_key, owner_id, other_ids):
+  other_key, other_model = get_linked_model(owner_key)
+  try:
+    missing_ids = get_missing_ids(other_model, other_ids)
+    insert_links(owner_key, owner_id, other_ids)
+    bump_version('recitations')
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+    raise
+  return missing_ids
+
+'''
+replace_links(owner_key, owner_id, other_ids)
+    links the owner to exactly the ids (the existing ones)
+    returns the missing ids
+'''
+def replace_links(owner_key, owner_id, other_ids):
+  other_key, other_model = get_linked_model(owner_key)
+  try:
+    missing_ids = get_missing_ids(other_model, other_ids)
+    db.session.execute(
+      recitations.delete()
+      .where(recitations.c[owner_key] == owner_id)
+      .where(recitations.c[other_key].notin_(other_ids))
+    )
+    insert_links(owner_key, owner_id, other_ids)
+    bump_version('recitations')
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+    raise
+  return missing_ids
+
+'''
+remove_links(owner_key, owner_id, other_ids)
+    unlinks the owner from the ids
+'''
+def remove_links(owner_key, owner_id, other_ids):
+  other_key, other_model = get_linked_model(owner_key)
+  try:
+    db.session.execute(
+      recitations.delete()
+      .where(recitations.c[owner_key] == owner_id)
+      .where(recitations.c[other_key].in_(other_ids))
+    )
+    bump_version('recitations')
+    db.session.commit()
+  except Exception:
+    db.session.rollback()
+    raise
+
+
 '''
 "actors" Table
 '''
@@ -39,7 +549,7 @@ class Actor(db.Model):
 
   id = Column(db.Integer, primary_key=True)
   firstname = Column(String)
-  lastname = Column(String)
+  lastname = Column(String, index=True)
   stagename = Column(String)
   gender = Column(String)
   birthdate = Column(Date)
@@ -65,13 +575,25 @@ class Actor(db.Model):
 
   def insert(self):
     db.session.add(self)
+    bump_version(self.__tablename__)
     db.session.commit()
 
+  @classmethod
+  def insert_many(cls, rows):
+    return bulk_insert(cls, rows)
+
+  @classmethod
+  def update_many(cls, changes):
+    return bulk_update(cls, changes)
+
   def update(self):
+    bump_version(self.__tablename__)
     db.session.commit()
 
   def delete(self):
     db.session.delete(self)
+    # deleting the row deletes its recitations too
+    bump_version(self.__tablename__, 'recitations')
     db.session.commit()
 
   def short(self):
@@ -81,6 +603,9 @@ class Actor(db.Model):
       'lastname': self.lastname,
       'stagename': self.stagename
     }
+  def partial(self, fields):
+    return { field: getattr(self, field) for field in fields }
+
   def long(self):
     return {
       'id': self.id,
@@ -99,8 +624,8 @@ class Movie(db.Model):
 
   id = Column(Integer, primary_key=True)
   title = Column(String)
-  genre = Column(String)
-  year = Column(Integer)
+  genre = Column(String, index=True)
+  year = Column(Integer, index=True)
   duration = Column(Integer)
   actors = db.relationship(
     'Actor',
@@ -116,13 +641,25 @@ class Movie(db.Model):
 
   def insert(self):
     db.session.add(self)
+    bump_version(self.__tablename__)
     db.session.commit()
 
+  @classmethod
+  def insert_many(cls, rows):
+    return bulk_insert(cls, rows)
+
+  @classmethod
+  def update_many(cls, changes):
+    return bulk_update(cls, changes)
+
   def update(self):
+    bump_version(self.__tablename__)
     db.session.commit()
 
   def delete(self):
     db.session.delete(self)
+    # deleting the row deletes its recitations too
+    bump_version(self.__tablename__, 'recitations')
     db.session.commit()
 
   def short(self):
@@ -132,6 +669,9 @@ class Movie(db.Model):
       'year': self.year
     }
   
+  def partial(self, fields):
+    return { field: getattr(self, field) for field in fields }
+
   def long(self):
     return {
       'id': self.id,
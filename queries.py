@@ -0,0 +1,388 @@
+# Libraries
+import os
+import json
+import base64
+import binascii
+import datetime
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import load_only
+
+# Page size of the list endpoints when the client does not send a limit
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+# Largest number of ids of a multi-get (?ids=1,2,3)
+MAX_IDS = int(os.environ.get('MAX_IDS', 100))
+# Largest value of an id column (Postgres INTEGER)
+MAX_ID = 2 ** 31 - 1
+# Rows fetched at a time from the server side cursor of the streamed lists
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+
+
+## QueryError Exception
+'''
+QueryError Exception
+Raised when the query string of a list endpoint is not valid (HTTP 400)
+'''
+class QueryError(Exception):
+    pass
+
+'''
+encode_cursor(values) method
+    @INPUTS
+        values: dict with the sort key values of the last row of a page
+
+    return an opaque, url safe cursor string
+'''
+def encode_cursor(values):
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+'''
+decode_cursor(cursor) method
+    @INPUTS
+        cursor: cursor string returned by encode_cursor
+
+    it should raise a QueryError if the cursor is malformed
+    return the dict of values
+'''
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, binascii.Error):
+        raise QueryError('Invalid cursor.')
+
+    if not isinstance(values, dict) or not isinstance(values.get('id'), int):
+        raise QueryError('Invalid cursor.')
+
+    return values
+
+'''
+get_page_size(args) method
+    @INPUTS
+        args: request query string
+
+    it should raise a QueryError if limit is not an integer between 1 and MAX_PAGE_SIZE
+    return the limit, DEFAULT_PAGE_SIZE if it is missing
+'''
+def get_page_size(args):
+    limit = args.get('limit')
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise QueryError('limit must be an integer.')
+
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise QueryError(f'limit must be between 1 and {MAX_PAGE_SIZE}.')
+
+    return limit
+
+'''
+get_ids(args) method
+    @INPUTS
+        args: request query string with the optional 'ids' (i.e. '3,1,2')
+
+    it should drop the repeated ids, keeping the first one
+    it should raise a QueryError if an id is not an integer of the id column range
+        (1 to MAX_ID), or there are none, or more than MAX_IDS
+    return the list of ids in the order of the request, None if 'ids' is missing
+'''
+def get_ids(args):
+    ids = args.get('ids')
+    if ids is None:
+        return None
+
+    try:
+        values = list(dict.fromkeys(
+            int(value) for value in ids.split(',') if value.strip()
+        ))
+    except ValueError:
+        raise QueryError('ids must be a comma separated list of integers.')
+
+    if not values:
+        raise QueryError('ids must not be empty.')
+    if any(value < 1 or value > MAX_ID for value in values):
+        raise QueryError(f'ids must be between 1 and {MAX_ID}.')
+    if len(values) > MAX_IDS:
+        raise QueryError(f'ids must hold at most {MAX_IDS} ids.')
+
+    return values
+
+'''
+get_many(query, model, ids) method
+    @INPUTS
+        query: SQLAlchemy query of the model
+        model: Actor or Movie
+        ids: list of ids, from get_ids
+
+    it should read all the rows with a single WHERE id IN (...) query
+    return the (rows in the order of ids, missing ids) tuple
+'''
+def get_many(query, model, ids):
+    rows = { row.id: row for row in query.filter(model.id.in_(ids)) }
+    return (
+        [ rows[row_id] for row_id in ids if row_id in rows ],
+        [ row_id for row_id in ids if row_id not in rows ]
+    )
+
+'''
+Filters of the list endpoints
+    query string parameter: (column, operator, type of the value)
+Every filter compiles to a SQL predicate on an indexed or cheap column.
+'''
+FILTERS = {
+    'actors': {
+        'lastname_prefix': ('lastname', 'prefix', str),
+        'gender': ('gender', 'eq', str),
+        'birthdate_from': ('birthdate', 'ge', datetime.date),
+        'birthdate_to': ('birthdate', 'le', datetime.date)
+    },
+    'movies': {
+        'genre': ('genre', 'eq', str),
+        'year_from': ('year', 'ge', int),
+        'year_to': ('year', 'le', int),
+        'duration_from': ('duration', 'ge', int),
+        'duration_to': ('duration', 'le', int)
+    }
+}
+
+# Fields that can be requested with ?fields= (the keys of Actor.long() / Movie.long())
+FIELDS = {
+    'actors': ('id', 'firstname', 'lastname', 'stagename', 'gender', 'birthdate'),
+    'movies': ('id', 'title', 'genre', 'year', 'duration')
+}
+
+# Columns the list endpoints can be sorted by (primary key or indexed)
+SORT_KEYS = {
+    'actors': ('id', 'lastname'),
+    'movies': ('id', 'year', 'genre')
+}
+
+# Convert a query string value to the type of the filter
+def parse_value(name, value, value_type):
+    try:
+        if value_type is int:
+            return int(value)
+        if value_type is datetime.date:
+            return datetime.date.fromisoformat(value)
+    except ValueError:
+        type_name = 'an integer' if value_type is int else 'a date (YYYY-MM-DD)'
+        raise QueryError(f'{name} must be {type_name}.')
+    return value
+
+# Check if the request only pages through the whole table (no filter, default sort)
+def is_plain_list(model, args):
+    return args.get('sort', 'id') == 'id' and not any(
+        name in args for name in FILTERS[model.__tablename__]
+    )
+
+'''
+get_fields(model, args) method
+    @INPUTS
+        model: Actor or Movie
+        args: request query string with the optional 'fields' (i.e. 'id,title')
+
+    it should raise a QueryError if a field is not in FIELDS
+    return the tuple of the requested fields, None if 'fields' is missing
+'''
+def get_fields(model, args):
+    fields = args.get('fields')
+    if fields is None:
+        return None
+
+    names = tuple(dict.fromkeys(
+        name.strip() for name in fields.split(',') if name.strip()
+    ))
+    allowed = FIELDS[model.__tablename__]
+    if not names or any(name not in allowed for name in names):
+        raise QueryError(f'fields must be a comma separated list of: {", ".join(allowed)}.')
+
+    return names
+
+'''
+load_fields(query, model, fields, args) method
+    @INPUTS
+        query: SQLAlchemy query of the model
+        model: Actor or Movie
+        fields: requested fields, from get_fields
+        args: request query string with the optional 'sort'
+
+    it should load only the columns of the fields, plus the id and the sort key
+        that the pagination needs
+    return the query, unchanged if fields is None
+'''
+def load_fields(query, model, fields, args=None):
+    if fields is None:
+        return query
+
+    names = set(fields) | { 'id' }
+    if args is not None:
+        names.add(get_sort(model, args)[0])
+
+    return query.options(load_only(*[ getattr(model, name) for name in names ]))
+
+'''
+filter_query(query, model, args) method
+    @INPUTS
+        query: SQLAlchemy query of the model
+        model: Actor or Movie
+        args: request query string
+
+    it should add a WHERE predicate for each filter of FILTERS in the query string
+        the lastname prefix is a range lower bound plus a LIKE, so the index gives
+        the start of the scan whatever the collation
+    it should raise a QueryError if a value has the wrong type
+    return the filtered query
+'''
+def filter_query(query, model, args):
+    for name, (column_name, operator, value_type) in FILTERS[model.__tablename__].items():
+        if name not in args:
+            continue
+
+        column = getattr(model, column_name)
+        value = parse_value(name, args[name], value_type)
+        if operator == 'eq':
+            query = query.filter(column == value)
+        elif operator == 'ge':
+            query = query.filter(column >= value)
+        elif operator == 'le':
+            query = query.filter(column <= value)
+        elif operator == 'prefix':
+            query = query.filter(column >= value, column.startswith(value, autoescape=True))
+
+    return query
+
+'''
+get_sort(model, args) method
+    @INPUTS
+        model: Actor or Movie
+        args: request query string with the optional 'sort' (i.e. 'year' or '-year')
+
+    it should raise a QueryError if the sort key is not in SORT_KEYS
+    return the (key, descending) tuple
+'''
+def get_sort(model, args):
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    key = sort[1:] if descending else sort
+
+    if key not in SORT_KEYS[model.__tablename__]:
+        allowed = ', '.join(SORT_KEYS[model.__tablename__])
+        raise QueryError(f'sort must be one of: {allowed} (prefix with - for descending order).')
+
+    return key, descending
+
+'''
+sort_query(query, model, args) method
+    @INPUTS
+        query: SQLAlchemy query of the model
+        model: Actor or Movie
+        args: request query string with the optional 'sort' and 'cursor'
+
+    it should order by the sort key, then by id to make the order total
+        NULLs come last in ascending order and first in descending order, as in
+        a Postgres index scan, so the index can serve both directions
+    it should seek past the cursor, which holds the sort key and the id of the last row
+    return the (sorted query, sort, key) tuple used to build the next cursor
+'''
+def sort_query(query, model, args):
+    key, descending = get_sort(model, args)
+    sort = args.get('sort', 'id')
+    column = getattr(model, key)
+
+    cursor = args.get('cursor')
+    if cursor:
+        values = decode_cursor(cursor)
+        if values.get('sort', 'id') != sort:
+            raise QueryError('The cursor was built for another sort.')
+
+        last_id = values['id']
+        if key == 'id':
+            query = query.filter(model.id < last_id if descending else model.id > last_id)
+        else:
+            last_key = values.get('key')
+            if last_key is not None and not isinstance(last_key, column.type.python_type):
+                raise QueryError('Invalid cursor.')
+            if descending and last_key is None:
+                query = query.filter(or_(
+                    and_(column.is_(None), model.id < last_id),
+                    column.isnot(None)
+                ))
+            elif descending:
+                query = query.filter(or_(
+                    column < last_key,
+                    and_(column == last_key, model.id < last_id)
+                ))
+            elif last_key is None:
+                query = query.filter(column.is_(None), model.id > last_id)
+            else:
+                query = query.filter(or_(
+                    column > last_key,
+                    and_(column == last_key, model.id > last_id),
+                    column.is_(None)
+                ))
+
+    if key == 'id':
+        order = [ model.id.desc() if descending else model.id ]
+    elif descending:
+        order = [ column.desc().nullsfirst(), model.id.desc() ]
+    else:
+        order = [ column.asc().nullslast(), model.id ]
+
+    return query.order_by(*order), sort, key
+
+# Cursor pointing after the given row
+def get_next_cursor(row, sort, key):
+    values = { 'id': row.id }
+    if sort != 'id':
+        values['sort'] = sort
+    if key != 'id':
+        values['key'] = getattr(row, key)
+    return encode_cursor(values)
+
+'''
+paginate(query, model, args) method
+    @INPUTS
+        query: SQLAlchemy query of the model
+        model: Actor or Movie
+        args: request query string with the optional filters, 'sort', 'limit' and 'cursor'
+
+    it should filter and sort the query in SQL (see filter_query and sort_query)
+    it should seek past the cursor (i.e. WHERE id > :last ORDER BY id LIMIT n)
+        so every page costs the same as the first one
+    it should fetch one extra row to know if there is a next page
+    return the (rows, next_cursor) tuple, next_cursor is None on the last page
+'''
+def paginate(query, model, args):
+    limit = get_page_size(args)
+
+    query = filter_query(query, model, args)
+    query, sort, key = sort_query(query, model, args)
+    rows = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = get_next_cursor(rows[-1], sort, key)
+
+    return rows, next_cursor
+
+'''
+stream_query(query, model, args) method
+    @INPUTS
+        query: SQLAlchemy query of the model
+        model: Actor or Movie
+        args: request query string with the optional filters, 'sort' and 'cursor'
+
+    it should filter and sort like paginate, start after the cursor and ignore the limit
+    it should read the rows through a server side cursor, STREAM_BATCH_SIZE at a time
+    return the query, to be iterated while the response is streamed
+'''
+def stream_query(query, model, args):
+    query = filter_query(query, model, args)
+    query, sort, key = sort_query(query, model, args)
+
+    return query.yield_per(STREAM_BATCH_SIZE)
@@ -0,0 +1,267 @@
+# Libraries
+import os
+import time
+import bisect
+import select
+import threading
+
+# App Modules
+from models import db, recitations, get_versions, add_write_listener, WRITE_CHANNEL
+from queries import QueryError, decode_cursor, encode_cursor, get_page_size
+from replicas import primary
+
+# Serve the GET routes from an in-memory snapshot of the tables
+READ_MODEL_ENABLED = os.environ.get('READ_MODEL', 'false').lower() == 'true'
+# Seconds between two version checks when there is no Postgres listener (i.e. SQLite)
+READ_MODEL_POLL_INTERVAL = float(os.environ.get('READ_MODEL_POLL_INTERVAL', 1))
+# Seconds to wait before reconnecting the Postgres listener
+READ_MODEL_RECONNECT_INTERVAL = 5
+
+TABLES = ('actors', 'movies', 'recitations')
+
+# Keys of Actor.short() and Movie.short()
+SHORT_KEYS = {
+    'actors': ('id', 'firstname', 'lastname', 'stagename'),
+    'movies': ('id', 'title', 'year')
+}
+
+
+'''
+Snapshot
+Immutable copy of the actors, movies and recitations tables
+    versions: table versions the snapshot was built from
+    rows: Actor.long() / Movie.long() dicts sorted by id
+    short_rows: Actor.short() / Movie.short() dicts sorted by id
+    movie_actors / actor_movies: ids of the cast of a movie and of the movies of an actor
+Nothing is changed after __init__: a new snapshot replaces the old one.
+'''
+class Snapshot:
+    def __init__(self, versions, rows, casts):
+        self.versions = versions
+        self.rows = { table: tuple(table_rows) for table, table_rows in rows.items() }
+        self.short_rows = {
+            table: tuple(
+                { key: row[key] for key in SHORT_KEYS[table] } for row in table_rows
+            ) for table, table_rows in self.rows.items()
+        }
+        self.ids = {
+            table: [ row['id'] for row in table_rows ]
+            for table, table_rows in self.rows.items()
+        }
+        self.by_id = {
+            table: { row['id']: row for row in table_rows }
+            for table, table_rows in self.rows.items()
+        }
+
+        movie_actors = {}
+        actor_movies = {}
+        for movie_id, actor_id in casts:
+            movie_actors.setdefault(movie_id, []).append(actor_id)
+            actor_movies.setdefault(actor_id, []).append(movie_id)
+        self.movie_actors = { key: tuple(sorted(ids)) for key, ids in movie_actors.items() }
+        self.actor_movies = { key: tuple(sorted(ids)) for key, ids in actor_movies.items() }
+
+    # Long dict of a row (or only the given fields), None if it does not exist
+    def get(self, table, row_id, fields=None):
+        row = self.by_id[table].get(row_id)
+        if row is None or fields is None:
+            return row
+        return { field: row[field] for field in fields }
+
+    # Long dicts (or only the given fields) of the ids in their order, and the missing ids
+    def get_many(self, table, ids, fields=None):
+        rows = [ self.get(table, row_id, fields) for row_id in ids ]
+        return (
+            [ row for row in rows if row is not None ],
+            [ row_id for row_id, row in zip(ids, rows) if row is None ]
+        )
+
+    # Short dicts (or only the given fields) of the rows after the given id,
+    # one more than limit to detect the next page
+    def page(self, table, after_id, limit, fields=None):
+        start = bisect.bisect_right(self.ids[table], after_id)
+        if fields is None:
+            return self.short_rows[table][start:start + limit + 1]
+        return tuple(
+            { field: row[field] for field in fields }
+            for row in self.rows[table][start:start + limit + 1]
+        )
+
+
+'''
+load_snapshot()
+    reads the three tables with plain SELECTs (no ORM objects)
+    the versions are read first, so the data is never older than them
+'''
+def load_snapshot():
+    versions = get_versions(*TABLES)
+    rows = {}
+    for table in [ 'actors', 'movies' ]:
+        table_object = db.metadata.tables[table]
+        rows[table] = [
+            dict(row._mapping)
+            for row in db.session.execute(
+                table_object.select().order_by(table_object.c.id)
+            )
+        ]
+    casts = [
+        (row.movie_id, row.actor_id)
+        for row in db.session.execute(recitations.select())
+        if row.movie_id is not None and row.actor_id is not None
+    ]
+    return Snapshot(versions, rows, casts)
+
+
+'''
+ReadModel
+Process-wide holder of the current Snapshot
+    it builds the snapshot lazily on first use and rebuilds it when it is stale,
+        while the other threads keep serving the previous one
+    writes of this process mark it stale through the models write listeners
+    writes of the other workers mark it stale through Postgres LISTEN/NOTIFY,
+        or are detected by checking the table versions every poll_interval seconds
+'''
+class ReadModel:
+    def __init__(self, enabled, poll_interval):
+        self.enabled = enabled
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.snapshot = None
+        self.stale = True
+        self.checked_at = 0
+        self.listening = False
+        self.pid = None
+
+    # Mark the snapshot stale if any of the written tables is in it
+    def invalidate(self, names=None):
+        if names is None or set(names) & set(TABLES):
+            self.stale = True
+
+    # Current snapshot, rebuilt first if needed
+    def get(self):
+        self.start_listener()
+
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self.lock:
+                if self.snapshot is None:
+                    self.rebuild()
+                return self.snapshot
+
+        poll_due = (not self.listening
+            and time.monotonic() - self.checked_at >= self.poll_interval)
+        if (self.stale or poll_due) and self.lock.acquire(blocking=False):
+            try:
+                self.refresh()
+            finally:
+                self.lock.release()
+
+        return self.snapshot
+
+    # The versions and the snapshot are read on the primary, even from a GET routed to a
+    # replica: a lagging replica would be served to every client until the next write
+    def refresh(self):
+        if not self.stale:
+            self.checked_at = time.monotonic()
+            with primary():
+                versions = get_versions(*TABLES)
+            if versions == self.snapshot.versions:
+                return
+        self.rebuild()
+
+    def rebuild(self):
+        # cleared before loading: a write committed meanwhile marks it stale again
+        self.stale = False
+        with primary():
+            self.snapshot = load_snapshot()
+        self.checked_at = time.monotonic()
+
+    # Table versions of the current snapshot
+    def versions(self, *names):
+        snapshot = self.get()
+        return { name: snapshot.versions[name] for name in names }
+
+    # Start the Postgres listener once per process (after a fork too)
+    def start_listener(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.listening = False
+
+        engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            return
+
+        thread = threading.Thread(target=self.listen, args=(engine,), daemon=True)
+        thread.start()
+
+    # Mark the snapshot stale on every notification of WRITE_CHANNEL
+    def listen(self, engine):
+        while True:
+            connection = None
+            try:
+                cargs, cparams = engine.dialect.create_connect_args(engine.url)
+                connection = engine.dialect.dbapi.connect(*cargs, **cparams)
+                connection.autocommit = True
+                connection.cursor().execute(f'LISTEN {WRITE_CHANNEL}')
+                self.listening = True
+                # writes may have been missed while disconnected
+                self.stale = True
+
+                while True:
+                    if select.select([ connection ], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    names = set()
+                    while connection.notifies:
+                        names.update(connection.notifies.pop(0).payload.split(','))
+                    if names:
+                        self.invalidate(names)
+            except Exception as error:
+                print(f'Read model listener error: {error}')
+                self.listening = False
+                if connection is not None:
+                    connection.close()
+                time.sleep(READ_MODEL_RECONNECT_INTERVAL)
+
+    '''
+    paginate(table, args, fields) method
+        @INPUTS
+            table: 'actors' or 'movies'
+            args: request query string with the optional 'limit' and 'cursor'
+            fields: fields to return, None for the short dicts
+
+        same contract as queries.paginate, served from the snapshot
+        it should raise a QueryError if the cursor was built for another sort
+        return the (dicts, next_cursor) tuple
+    '''
+    def paginate(self, table, args, fields=None):
+        limit = get_page_size(args)
+
+        after_id = 0
+        cursor = args.get('cursor')
+        if cursor:
+            values = decode_cursor(cursor)
+            # the snapshot only pages by id, like the plain lists of is_plain_list
+            if values.get('sort', 'id') != 'id':
+                raise QueryError('The cursor was built for another sort.')
+            after_id = values['id']
+
+        snapshot = self.get()
+        rows = snapshot.page(table, after_id, limit, fields)
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            # the id of the last row, even if it is not in the requested fields
+            start = bisect.bisect_right(snapshot.ids[table], after_id)
+            next_cursor = encode_cursor({ 'id': snapshot.ids[table][start + limit - 1] })
+
+        return list(rows), next_cursor
+
+
+read_model = ReadModel(READ_MODEL_ENABLED, READ_MODEL_POLL_INTERVAL)
+add_write_listener(read_model.invalidate)
@@ -0,0 +1,245 @@
+# Libraries
+import os
+import time
+import itertools
+import threading
+import weakref
+import contextlib
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event, text
+
+# App Modules
+from models import db, set_read_bind, REPLICA_BIND_PREFIX
+from metrics import Counter, add_metric, add_collector
+
+# Seconds between two health checks of a replica
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+# Seconds a Postgres replica may lag behind the primary before it is ejected, 0 for no limit
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 10))
+# Seconds the GET requests of a client read the primary after its last write
+READ_YOUR_WRITES_SECONDS = int(os.environ.get('READ_YOUR_WRITES_SECONDS', 10))
+
+# Set on the write responses, until when the client reads the primary (unix time)
+READ_YOUR_WRITES_COOKIE = 'cinema_read_primary_until'
+# 'X-Read-Your-Writes: true' sends a GET request to the primary, i.e. from a client without cookies
+READ_YOUR_WRITES_HEADER = 'X-Read-Your-Writes'
+
+# Seconds a caught-up Postgres replica lags: 0, NULL on a primary
+LAG_QUERY = text(
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+)
+
+reads = add_metric(Counter(
+    'cinema_db_reads_total',
+    'GET requests by database they read, the primary or a replica bind.',
+    [ 'target' ]
+))
+
+
+'''
+Replica
+Read replica of the primary database, the REPLICA_BIND_PREFIX bind of key
+    healthy: result of the last health check, a replica that failed it (or lost a connection)
+        is ejected until one succeeds
+    check() runs the health check, bounded by REPLICA_CONNECT_TIMEOUT on Postgres
+'''
+class Replica:
+    def __init__(self, app, key):
+        self.app = app
+        self.key = key
+        # None until the first health check
+        self.healthy = None
+        self.checked_at = None
+        self.engine = None
+
+    def get_engine(self):
+        engine = db.get_engine(self.app, self.key)
+        if engine is not self.engine:
+            # a lost connection ejects the replica at once, without waiting for the next check
+            event.listen(engine, 'handle_error', self.on_error)
+            self.engine = engine
+        return engine
+
+    def on_error(self, context):
+        # no connection: the replica refused (or timed out) a new one
+        if context.connection is None:
+            self.set_healthy(False, f'connection failed: {context.original_exception}')
+        elif context.is_disconnect:
+            self.set_healthy(False, f'connection lost: {context.original_exception}')
+
+    def set_healthy(self, healthy, reason=None):
+        if not healthy and self.healthy is not False:
+            print(f'Replica {self.key} ejected: {reason}')
+        elif healthy and self.healthy is False:
+            print(f'Replica {self.key} back in rotation')
+        self.healthy = healthy
+
+    def check(self):
+        try:
+            with self.get_engine().connect() as connection:
+                if connection.dialect.name == 'postgresql':
+                    lag = connection.execute(LAG_QUERY).scalar() or 0
+                else:
+                    connection.execute(text('SELECT 1'))
+                    lag = 0
+        except Exception as error:
+            self.set_healthy(False, f'health check error: {error}')
+        else:
+            if REPLICA_MAX_LAG > 0 and lag > REPLICA_MAX_LAG:
+                self.set_healthy(False, f'{lag:.1f} s behind the primary')
+            else:
+                self.set_healthy(True)
+        self.checked_at = time.monotonic()
+
+'''
+ReplicaSet
+Replicas of an app, chosen round robin among the healthy ones
+    the health checks run every REPLICA_CHECK_INTERVAL seconds in a background thread of
+        each process, never in a request: a slow or unreachable replica does not hold one
+    choose() return a Replica, None when there is none or none is healthy (or checked yet)
+    check() runs the health check of every replica now
+'''
+class ReplicaSet:
+    def __init__(self, app):
+        self.replicas = [
+            Replica(app, key) for key in sorted(app.config.get('SQLALCHEMY_BINDS') or ())
+            if key.startswith(REPLICA_BIND_PREFIX)
+        ]
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.checker = None
+
+    def check(self):
+        with self.lock:
+            for replica in self.replicas:
+                replica.check()
+
+    # The thread does not survive a fork (gunicorn --preload): each worker starts its own
+    def start_checks(self):
+        if self.checker is not None and self.checker.is_alive():
+            return
+        with self.lock:
+            if self.checker is None or not self.checker.is_alive():
+                self.checker = threading.Thread(
+                    target=run_checks, args=(weakref.ref(self),),
+                    name='replica-checks', daemon=True
+                )
+                self.checker.start()
+
+    def choose(self):
+        self.start_checks()
+        healthy = [ replica for replica in self.replicas if replica.healthy ]
+        if not healthy:
+            return None
+        return healthy[next(self.counter) % len(healthy)]
+
+# Health check loop of a ReplicaSet, it stops with the app
+def run_checks(replica_set_ref):
+    while True:
+        replica_set = replica_set_ref()
+        if replica_set is None:
+            return
+        replica_set.check()
+        del replica_set
+        time.sleep(REPLICA_CHECK_INTERVAL)
+
+_replica_sets = weakref.WeakSet()
+
+@add_collector
+def replica_metrics():
+    replicas = [ replica for replica_set in list(_replica_sets) for replica in replica_set.replicas ]
+    return [
+        ('cinema_db_replicas', 'gauge', 'Read replicas configured.', len(replicas)),
+        ('cinema_db_replicas_healthy', 'gauge', 'Read replicas in rotation.',
+            sum(1 for replica in replicas if replica.healthy))
+    ]
+
+# Create the replicas of the app, from its SQLALCHEMY_BINDS (see models.setup_db)
+def init_app(app):
+    replica_set = ReplicaSet(app)
+    app.extensions['replicas'] = replica_set
+    _replica_sets.add(replica_set)
+    return replica_set
+
+
+'''
+reads_own_writes() method
+    it should tell if the client asked to read the primary, with READ_YOUR_WRITES_HEADER
+        or with the READ_YOUR_WRITES_COOKIE of a recent write
+'''
+def reads_own_writes():
+    if request.headers.get(READ_YOUR_WRITES_HEADER, '').lower() == 'true':
+        return True
+    try:
+        return float(request.cookies.get(READ_YOUR_WRITES_COOKIE)) > time.time()
+    except (TypeError, ValueError):
+        return False
+
+'''
+route_request() method
+    before_request hook
+    it should send the reads of a GET request to a healthy replica, the same one for the
+        whole request, unless the client reads its own writes
+    every other request (and everything outside a request) uses the primary
+'''
+def route_request():
+    g.read_replica = None
+    replica_set = current_app.extensions.get('replicas')
+    if not replica_set or not replica_set.replicas or request.method not in ('GET', 'HEAD'):
+        return
+
+    if not reads_own_writes():
+        g.read_replica = replica_set.choose()
+    reads.inc((g.read_replica.key if g.read_replica is not None else 'primary',))
+
+'''
+remember_write(response) method
+    after_request hook
+    it should set READ_YOUR_WRITES_COOKIE on the successful writes, so the next
+        READ_YOUR_WRITES_SECONDS of GET requests of the client see them even if
+        the replicas are behind
+    return the response
+'''
+def remember_write(response):
+    replica_set = current_app.extensions.get('replicas')
+    if (not replica_set or not replica_set.replicas or READ_YOUR_WRITES_SECONDS <= 0
+            or request.method in ('GET', 'HEAD', 'OPTIONS') or response.status_code >= 400):
+        return response
+
+    response.set_cookie(
+        READ_YOUR_WRITES_COOKIE,
+        str(int(time.time()) + READ_YOUR_WRITES_SECONDS),
+        max_age=READ_YOUR_WRITES_SECONDS,
+        httponly=True,
+        samesite='Lax'
+    )
+    return response
+
+# Read the primary for the rest of the request, i.e. before writing what was read
+def use_primary():
+    if has_request_context():
+        g.read_replica = None
+
+'''
+primary() context manager
+    reads the primary inside the block, i.e. to build a process-wide cache that must not
+    see a lagging replica, and the replica of the request again after it
+'''
+@contextlib.contextmanager
+def primary():
+    replica = g.get('read_replica') if has_request_context() else None
+    use_primary()
+    try:
+        yield
+    finally:
+        if replica is not None:
+            g.read_replica = replica
+
+# Engine of the reads of the current request (see models.RoutingSession), None for the primary
+@set_read_bind
+def get_read_engine():
+    if not has_request_context():
+        return None
+    replica = g.get('read_replica')
+    return replica.get_engine() if replica is not None else None
@@ -0,0 +1,130 @@
+# Libraries
+import os
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# App Modules
+from metrics import Histogram, add_metric, record_phase
+from json_provider import jsonify
+
+# Statements slower than this (milliseconds) are logged with the shape of their parameters
+SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD', 200))
+# Statements allowed in a request
+SQL_MAX_STATEMENTS = int(os.environ.get('SQL_MAX_STATEMENTS', 50))
+# Times the same SELECT can run in a request before it looks like an N+1 loop
+SQL_MAX_REPEATS = int(os.environ.get('SQL_MAX_REPEATS', 3))
+# Fail the requests over the limits with a 500 (i.e. in the tests), log them otherwise
+SQL_STRICT = os.environ.get('SQL_STRICT', 'false').lower() == 'true'
+
+request_statements = add_metric(Histogram(
+    'cinema_request_sql_statements',
+    'SQL statements run by the requests.',
+    [ 'route', 'method' ],
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100)
+))
+
+
+'''
+get_parameters_shape(parameters) method
+    @INPUTS
+        parameters: bound parameters of a statement (dict, sequence, or a list of them
+            for an executemany)
+
+    it should keep the names and the types of the values, never the values
+    return a short string, i.e. {id_1: int, param_1: str} or 100 x (str, int)
+'''
+def get_parameters_shape(parameters):
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(
+            f'{name}: {type(value).__name__}' for name, value in parameters.items()
+        ) + '}'
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return f'{len(parameters)} x {get_parameters_shape(parameters[0])}'
+        return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+    return type(parameters).__name__
+
+# Start the statement timer
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info['statement_start'] = time.perf_counter()
+
+'''
+end_statement event
+    it should add the statement to the db phase and the counters of the request
+    it should log the statements slower than SLOW_QUERY_THRESHOLD, in a request or not
+'''
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('statement_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+
+    if elapsed * 1000 >= SLOW_QUERY_THRESHOLD:
+        where = f'{request.method} {request.path}' if has_request_context() else 'no request'
+        print(
+            f'Slow query ({elapsed * 1000:.1f} ms, {where}): {" ".join(statement.split())}'
+            f' parameters: {get_parameters_shape(parameters)}'
+        )
+
+    if not has_request_context():
+        return
+    record_phase('db', elapsed)
+    sql = g.get('sql')
+    if sql is not None:
+        sql['statements'] += 1
+        if statement.lstrip()[:6].upper() == 'SELECT':
+            sql['selects'][statement] = sql['selects'].get(statement, 0) + 1
+
+# before_request hook: start counting the statements of the request
+def start_request():
+    g.sql = { 'statements': 0, 'selects': {} }
+
+'''
+get_violation(sql) method
+    @INPUTS
+        sql: counters of a request
+
+    return the description of the broken limit, None if the request is within them
+'''
+def get_violation(sql):
+    if sql['statements'] > SQL_MAX_STATEMENTS:
+        return f'{sql["statements"]} SQL statements (at most {SQL_MAX_STATEMENTS})'
+    for statement, count in sql['selects'].items():
+        if count > SQL_MAX_REPEATS:
+            return f'the same SELECT ran {count} times (N+1?): {" ".join(statement.split())}'
+    return None
+
+'''
+finish_request(response) method
+    after_request hook
+    it should observe the number of statements of the request
+    it should log a request over SQL_MAX_STATEMENTS or SQL_MAX_REPEATS,
+        and replace its response with a 500 in strict mode
+    return the response
+'''
+def finish_request(response):
+    sql = g.pop('sql', None)
+    if sql is None:
+        return response
+
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_statements.observe((route, request.method), sql['statements'])
+
+    violation = get_violation(sql)
+    if violation is None:
+        return response
+
+    print(f'{request.method} {request.path} SQL budget exceeded: {violation}')
+    if not SQL_STRICT:
+        return response
+    response = jsonify({
+        'success': False,
+        'error': 500,
+        'message': f'SQL budget exceeded: {violation}'
+    })
+    response.status_code = 500
+    return response
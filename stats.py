@@ -0,0 +1,186 @@
+# Libraries
+import os
+import json
+import datetime
+import threading
+from sqlalchemy import select, func, update
+from sqlalchemy.exc import IntegrityError
+
+# App Modules
+from models import db, Actor, Movie, CatalogueStats, recitations, get_versions
+from replicas import use_primary
+
+# Seconds between two refreshes triggered by a GET /stats, the writes in between
+# are served stale (POST /stats/refresh is not limited)
+STATS_MIN_REFRESH_INTERVAL = float(os.environ.get('STATS_MIN_REFRESH_INTERVAL', 10))
+
+# Tables the statistics are computed from
+TABLES = ('actors', 'movies', 'recitations')
+# Primary key of the single catalogue_stats row
+NAME = 'catalogue'
+
+# One refresh at a time in a process, claim_refresh() elects one process among the workers
+_refresh_lock = threading.Lock()
+
+
+# Key of the table versions, i.e. actors=3,movies=5,recitations=2
+def get_versions_key(versions):
+    return ','.join(f'{name}={version}' for name, (version, updated_at) in sorted(versions.items()))
+
+# Average of a [{size_key: size, count_key: count}] distribution, None if it is empty
+def get_average(distribution, size_key, count_key):
+    total = sum(row[count_key] for row in distribution)
+    if not total:
+        return None
+    return round(sum(row[size_key] * row[count_key] for row in distribution) / total, 2)
+
+'''
+get_size_distribution(owner_table, owner_key, other_key) method
+    it should count the links of every row of owner_table (0 included), then the rows
+        of each count, with two GROUP BY and without loading the rows
+    return [(size, rows)] sorted by size
+'''
+def get_size_distribution(owner_table, owner_key, other_key):
+    sizes = (
+        select(owner_table.c.id, func.count(recitations.c[other_key]).label('size'))
+        .select_from(owner_table.outerjoin(recitations, recitations.c[owner_key] == owner_table.c.id))
+        .group_by(owner_table.c.id)
+        .subquery()
+    )
+    return db.session.execute(
+        select(sizes.c.size, func.count())
+        .group_by(sizes.c.size)
+        .order_by(sizes.c.size)
+    ).all()
+
+'''
+compute_stats() method
+    it should compute every aggregate of the catalogue with set-based queries:
+        movie counts per genre and per year, average duration, cast sizes
+        and actor filmography counts
+    return a JSON serializable dict
+'''
+def compute_stats():
+    movies = Movie.__table__
+    actors = Actor.__table__
+
+    by_genre = db.session.execute(
+        select(movies.c.genre, func.count())
+        .group_by(movies.c.genre)
+        .order_by(func.count().desc(), movies.c.genre)
+    ).all()
+    by_year = db.session.execute(
+        select(movies.c.year, func.count())
+        .group_by(movies.c.year)
+        .order_by(movies.c.year)
+    ).all()
+    average_duration = db.session.execute(select(func.avg(movies.c.duration))).scalar()
+
+    cast_sizes = [
+        { 'actors': size, 'movies': count }
+        for size, count in get_size_distribution(movies, 'movie_id', 'actor_id')
+    ]
+    filmography_sizes = [
+        { 'movies': size, 'actors': count }
+        for size, count in get_size_distribution(actors, 'actor_id', 'movie_id')
+    ]
+
+    return {
+        'movies': sum(row['movies'] for row in cast_sizes),
+        'actors': sum(row['actors'] for row in filmography_sizes),
+        'movies_by_genre': [ { 'genre': genre, 'movies': count } for genre, count in by_genre ],
+        'movies_by_year': [ { 'year': year, 'movies': count } for year, count in by_year ],
+        'average_duration': round(float(average_duration), 2) if average_duration is not None else None,
+        'cast_sizes': cast_sizes,
+        'average_cast_size': get_average(cast_sizes, 'actors', 'movies'),
+        'filmography_sizes': filmography_sizes,
+        'average_filmography_size': get_average(filmography_sizes, 'movies', 'actors')
+    }
+
+'''
+store_stats() method
+    it should compute the statistics on the primary and store them in catalogue_stats,
+        with the table versions read before them: a write in between only
+        triggers one more refresh
+    return the CatalogueStats row
+'''
+def store_stats():
+    use_primary()
+    try:
+        versions = get_versions(*TABLES)
+        row = CatalogueStats(
+            name=NAME,
+            data=json.dumps(compute_stats()),
+            versions=get_versions_key(versions),
+            refreshed_at=datetime.datetime.utcnow()
+        )
+        row = db.session.merge(row)
+        db.session.commit()
+    except IntegrityError:
+        # a concurrent request inserted the first row: it is as fresh as this one
+        db.session.rollback()
+        return CatalogueStats.query.get(NAME)
+    except Exception:
+        db.session.rollback()
+        raise
+    return row
+
+# Refresh the statistics now, after the refresh running in this process if any
+def refresh_stats():
+    with _refresh_lock:
+        return store_stats()
+
+'''
+claim_refresh(row) method
+    it should move refreshed_at of the stored row forward, only if it is still the one read:
+        a conditional UPDATE, so a single worker wins the stale row and the others
+        serve it until the next STATS_MIN_REFRESH_INTERVAL
+    return True when this process won the refresh
+'''
+def claim_refresh(row):
+    use_primary()
+    table = CatalogueStats.__table__
+    try:
+        result = db.session.execute(
+            update(table)
+            .where(table.c.name == NAME, table.c.refreshed_at == row.refreshed_at)
+            .values(refreshed_at=datetime.datetime.utcnow())
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result.rowcount == 1
+
+'''
+get_stats() method
+    it should refresh the stored statistics when a table changed since they were computed,
+        at most once every STATS_MIN_REFRESH_INTERVAL seconds and in a single request:
+        the requests arriving during a refresh get the stored row, stale
+    return the CatalogueStats row and whether it is stale (a table changed since)
+'''
+def get_stats():
+    row = CatalogueStats.query.get(NAME)
+    if row is None:
+        if _refresh_lock.acquire(blocking=False):
+            try:
+                return store_stats(), False
+            finally:
+                _refresh_lock.release()
+        # nothing to serve yet: wait for the first refresh, running in another thread
+        with _refresh_lock:
+            row = CatalogueStats.query.get(NAME)
+        if row is None:
+            return refresh_stats(), False
+
+    if row.versions == get_versions_key(get_versions(*TABLES)):
+        return row, False
+    age = (datetime.datetime.utcnow() - row.refreshed_at).total_seconds()
+    if age < STATS_MIN_REFRESH_INTERVAL or not _refresh_lock.acquire(blocking=False):
+        return row, True
+    try:
+        if not claim_refresh(row):
+            return row, True
+        return store_stats(), False
+    finally:
+        _refresh_lock.release()